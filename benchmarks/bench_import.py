@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Import-time benchmark of the chef's modules. Each module is imported in a fresh
+Python process (so nothing is cached in `sys.modules`) and the benchmark fails
+if an import is slower than `--max-time` or loads one of HEAVY_MODULES, which
+must only be imported by the stages that need them. Usage:
+
+    ./benchmarks/bench_import.py                    # sushichef and the lib modules
+    ./benchmarks/bench_import.py --max-time 0.5     # fail on imports slower than 0.5s
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+MODULES = ['sushichef', 'libcache', 'libhttp', 'libjsontree', 'libmetrics', 'libpyppeteer', 'libscheduler']
+HEAVY_MODULES = ['bs4', 'html2text', 'PIL', 'pyppeteer', 'requests', 'ricecooker']
+LAZY_MODULES = [module for module in MODULES if module != 'libhttp']   # must not load HEAVY_MODULES
+DEFAULT_REPEAT = 5
+DEFAULT_MAX_TIME = 0.3        # seconds
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+heavy_modules = [name for name in {heavy_modules!r} if name in sys.modules]
+print(json.dumps(dict(duration=duration, heavy_modules=heavy_modules)))
+"""
+
+
+def time_import(module):
+    """
+    Import `module` in a new Python process and return a dict with the import
+    `duration` and the `heavy_modules` it loaded.
+    """
+    script = IMPORT_SCRIPT.format(module=module, heavy_modules=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=REPO_DIR)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run_import_benchmark(module, repeat=DEFAULT_REPEAT):
+    results = [time_import(module) for i in range(repeat)]
+    times = [result['duration'] for result in results]
+    return dict(
+        median_time=statistics.median(times),
+        min_time=min(times),
+        heavy_modules=results[-1]['heavy_modules'],
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the import time of the chef modules.')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='Modules to import (default all).')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Number of imports per module.')
+    parser.add_argument('--max-time', type=float, default=DEFAULT_MAX_TIME,
+                        help='Max median import time in seconds (default {}).'.format(DEFAULT_MAX_TIME))
+    args = parser.parse_args()
+
+    failures = []
+    print('{:16s} {:>10s} {:>10s}  {}'.format('module', 'median', 'min', 'heavy modules loaded'))
+    for module in args.modules:
+        result = run_import_benchmark(module, repeat=args.repeat)
+        print('{:16s} {:>9.4f}s {:>9.4f}s  {}'.format(
+            module, result['median_time'], result['min_time'], ', '.join(result['heavy_modules']) or '-'))
+        if result['median_time'] > args.max_time:
+            failures.append('{} takes {:.3f}s to import'.format(module, result['median_time']))
+        if module in LAZY_MODULES and result['heavy_modules']:
+            failures.append('{} imports {}'.format(module, ', '.join(result['heavy_modules'])))
+    if failures:
+        print('Failures:', '; '.join(failures))
+        sys.exit(1)
@@ -0,0 +1,233 @@
+"""
+Deterministic Edraak-like component fixtures for the benchmarks. They follow
+the structure and HTML markup of the components returned by the Edraak API
+(see the samples in notebooks/), so the benchmarks run without network access.
+"""
+import base64
+from io import BytesIO
+import random
+
+from PIL import Image
+
+
+SEED = 1234
+
+PARAGRAPH_TEMPLATE = (
+    '<p dir="rtl" style="line-height: 1.2; margin-top: 0pt; margin-bottom: 0pt; text-align: justify;">'
+    '<span style="font-size: 11pt; font-family: \'Open Sans\'; color: #000000; background-color: transparent; '
+    'font-weight: 400; font-style: normal; font-variant: normal; text-decoration: none; '
+    'vertical-align: baseline; white-space: pre-wrap;">{}</span></p>\n'
+)
+ARABIC_SENTENCES = [
+    'مستخدماً التقدير الذهني، أجب عن السؤال التالي بنعم أو لا:',
+    'لدى عامر مبلغ ٥ دنانير ويريد تناول وجبة تتكون من شاورما سعرها &nbsp;٣٫٥ دينار وعصير فواكه سعره ١٫٢٥ دينار.',
+    'هل يكفي المبلغ الذي مع عامر لتناول الوجبة ؟',
+    'القيمة المنزلية للرقم ٦ في العدد ١٦٤٥٣٠٩٨٧هي:',
+    'يقدر نواتج العمليّات الحسابيّة على الأعداد النسبيّة ذهنيا بدرجة معقولة',
+]
+
+
+def make_png_data_uri(width, height, rng):
+    """
+    Return a base64 data URI of a PNG image of size `width` x `height`.
+    """
+    image = Image.new('RGB', (width, height), color=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    for i in range(0, width, 7):   # some detail so the PNG is not trivially small
+        image.putpixel((i, (i*31) % height), (rng.randrange(256), 0, 0))
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def make_paragraphs(rng, num_paragraphs, uid):
+    paragraphs = []
+    for i in range(num_paragraphs):
+        sentence = rng.choice(ARABIC_SENTENCES)
+        paragraphs.append(PARAGRAPH_TEMPLATE.format(sentence + ' ({}.{})'.format(uid, i)))
+    return ''.join(paragraphs)
+
+def make_table_html(rng, num_rows, num_cols, uid):
+    rows = []
+    for r in range(num_rows):
+        cells = []
+        for c in range(num_cols):
+            cells.append('<td style="width: 50px;"><p dir="rtl">{}</p> <p>{}</p></td>'.format(
+                rng.randrange(1000), uid + r*num_cols + c))
+        rows.append('<tr>' + ''.join(cells) + '</tr>')
+    return '<table border="1"><tbody>' + ''.join(rows) + '</tbody></table>\n'
+
+def make_question_html(rng, uid, num_paragraphs=3, table=False, image=None):
+    """
+    HTML of a question description with `num_paragraphs` paragraphs, an
+    optional table, and an optional <img> tag with `image` as src.
+    """
+    html = make_paragraphs(rng, num_paragraphs, uid)
+    if table:
+        html += make_table_html(rng, 3, 4, uid)
+    if image:
+        html += '<p style="text-align: center;"><img style="width: 300px;" src="{}" alt="" /></p>\n'.format(image)
+    return html
+
+
+def make_html_fragments(count=200, seed=SEED):
+    """
+    Unique question, choice, and hint HTML fragments (no images).
+    """
+    rng = random.Random(seed)
+    fragments = []
+    for i in range(count):
+        if i % 3 == 0:
+            fragments.append(make_question_html(rng, i, num_paragraphs=4, table=(i % 6 == 0)))
+        else:
+            fragments.append('<p dir="rtl"><span>{} {}</span></p>'.format(rng.choice(ARABIC_SENTENCES), i))
+    return fragments
+
+def make_tables_page_html(num_tables=20, seed=SEED):
+    rng = random.Random(seed)
+    return ''.join(make_table_html(rng, 6, 5, i*100) for i in range(num_tables))
+
+def make_images_page_html(num_images=20, seed=SEED):
+    """
+    HTML with `num_images` base64 PNG images, half of them wider than
+    EXERCISE_IMAGE_MAX_WIDTH so that they get resized.
+    """
+    rng = random.Random(seed)
+    parts = []
+    for i in range(num_images):
+        width = 800 if i % 2 == 0 else 300
+        parts.append(make_question_html(rng, i, num_paragraphs=1, image=make_png_data_uri(width, 200, rng)))
+    return ''.join(parts)
+
+
+def make_multiple_choice_question(rng, uid, image=None):
+    num_choices = 4
+    correct = rng.randrange(num_choices)
+    return dict(
+        id='mcq{:08d}'.format(uid),
+        component_type='MultipleChoiceQuestion',
+        title='Untitled',
+        full_description=make_question_html(rng, uid, num_paragraphs=3, table=(uid % 5 == 0), image=image),
+        choices=[
+            dict(description='<p dir="rtl">{} {}</p>'.format(rng.choice(ARABIC_SENTENCES), uid*10 + i),
+                 is_correct=(i == correct))
+            for i in range(num_choices)
+        ],
+        hints=[dict(description=make_paragraphs(rng, 1, uid)), dict(description='')],
+        explanation=None,
+    )
+
+def make_numeric_response_question(rng, uid):
+    return dict(
+        id='nrq{:08d}'.format(uid),
+        component_type='NumericResponseQuestion',
+        title='السؤال الأول',
+        full_description=make_question_html(rng, uid, num_paragraphs=2),
+        correct_answer_precise=float(rng.randrange(100000)),
+        hints=[dict(description=make_paragraphs(rng, 1, uid))],
+        explanation=None,
+    )
+
+def make_questions(component_type, count=50, seed=SEED):
+    rng = random.Random(seed)
+    if component_type == 'MultipleChoiceQuestion':
+        return [make_multiple_choice_question(rng, i) for i in range(count)]
+    return [make_numeric_response_question(rng, i) for i in range(count)]
+
+def make_exercise(rng, uid, num_questions=10, image_every=0):
+    """
+    Exercise component with `num_questions` questions. Every `image_every`-th
+    multiple choice question has a base64 image (no images if 0).
+    """
+    children = []
+    for i in range(num_questions):
+        question_uid = uid*1000 + i
+        if i % 3 == 2:
+            children.append(make_numeric_response_question(rng, question_uid))
+        else:
+            image = None
+            if image_every and i % image_every == 0:
+                image = make_png_data_uri(800 if i % 2 == 0 else 300, 120, rng)
+            children.append(make_multiple_choice_question(rng, question_uid, image=image))
+    return dict(
+        id='ex{:08d}'.format(uid),
+        component_type='Exercise',
+        title='يقدر نواتج العمليّات الحسابيّة {}'.format(uid),
+        full_description=None,
+        question_set=dict(children=children),
+    )
+
+def make_video(rng, uid):
+    return dict(
+        id='vid{:08d}'.format(uid),
+        component_type='Video',
+        title='Video {}'.format(uid),
+        full_description='<p>{}</p>'.format(rng.choice(ARABIC_SENTENCES)),
+        video_info=dict(encoded_videos=[
+            dict(profile='youtube', url='yt{:09d}'.format(uid)),
+            dict(profile='desktop_mp4', url='https://example.com/{}.mp4'.format(uid)),
+        ]),
+    )
+
+
+def make_course(num_sections=3, num_subsections=4, num_lessons=3, questions_per_exercise=8, seed=SEED):
+    """
+    Returns (course, components) where `course` is the component hierarchy of a
+    course as returned for the course's root component, and `components` is a
+    dict of the full data of its leaf components (Video, Exercise, Test), keyed
+    by component id. The last subsection of each section imports the first
+    lesson of the course, like the ImportedComponents in the Edraak courses.
+    """
+    rng = random.Random(seed)
+    components = {}
+    uid = 0
+
+    def add_leaf(component):
+        components[component['id']] = component
+        return dict(id=component['id'], component_type=component['component_type'], title=component['title'])
+
+    sections = []
+    first_lesson = None
+    for s in range(num_sections):
+        subsections = []
+        for ss in range(num_subsections):
+            lessons = []
+            for l in range(num_lessons):
+                uid += 1
+                children = [add_leaf(make_video(rng, uid)),
+                            add_leaf(make_exercise(rng, uid, num_questions=questions_per_exercise, image_every=4))]
+                lesson = dict(id='les{:08d}'.format(uid), component_type='OnlineLesson',
+                              title='الدرس {}'.format(uid), children=children)
+                first_lesson = first_lesson or lesson
+                lessons.append(lesson)
+            if ss == num_subsections - 1:
+                lessons.append(dict(id='imp{:08d}'.format(s), component_type='ImportedComponent',
+                                    target_component=first_lesson))
+            subsections.append(dict(id='sub{:04d}{:04d}'.format(s, ss), component_type='SubSection',
+                                    title='الوحدة {}.{}'.format(s, ss), children=lessons))
+        uid += 1
+        test = make_exercise(rng, uid, num_questions=questions_per_exercise)
+        test['component_type'] = 'Test'
+        subsections.append(add_leaf(test))
+        sections.append(dict(id='sec{:08d}'.format(s), component_type='Section',
+                             title='الفصل {}'.format(s), children=subsections))
+    course = dict(id='course0001', component_type='Section', title='التفاضل والتكامل', children=sections)
+    return course, components
+
+
+def make_networktab(num_events=200000, seed=SEED):
+    """
+    A Chromium trace like the ones saved by `visit_page(url, networktab=True)`,
+    with `num_events` events of which about 1% are `ResourceSendRequest`s.
+    """
+    rng = random.Random(seed)
+    event_names = ['ParseHTML', 'FunctionCall', 'Paint', 'UpdateLayerTree', 'EvaluateScript', 'TimerFire']
+    events = []
+    for i in range(num_events):
+        if i % 100 == 0:
+            url = 'https://programs.edraak.org/api/component/{:024x}/'.format(rng.getrandbits(96))
+            events.append(dict(name='ResourceSendRequest', ph='I', ts=i, pid=1, tid=1, cat='devtools.timeline',
+                               args=dict(data=dict(requestId=str(i), url=url, requestMethod='GET', priority='High'))))
+        else:
+            events.append(dict(name=rng.choice(event_names), ph='X', ts=i, dur=rng.randrange(100), pid=1, tid=1,
+                               cat='devtools.timeline', args=dict(data=dict(frame='F1'))))
+    return dict(traceEvents=events, metadata={'clock-domain': 'LINUX_CLOCK_MONOTONIC'})
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the transform and image hot paths of the chef, using the
+deterministic component fixtures from fixtures.py. Usage:
+
+    ./benchmarks/run_benchmarks.py                      # run all benchmarks
+    ./benchmarks/run_benchmarks.py --filter question    # only benchmarks matching
+    ./benchmarks/run_benchmarks.py --save-baseline      # save results as the baseline
+    ./benchmarks/run_benchmarks.py --compare            # compare results to the baseline
+
+Each benchmark runs `--repeat` times and reports the median time, the throughput,
+and the peak memory allocated by Python (measured in a separate run using
+tracemalloc, so memory allocated by C libraries like PIL is not included).
+Benchmarks run in a temporary directory so the chefdata/ of the repo is not used.
+"""
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from bs4 import BeautifulSoup
+
+import fixtures
+from libpyppeteer import get_resource_requests_from_networktab
+import sushichef
+
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10      # report changes of more than 10%
+
+
+class Benchmark(object):
+    """
+    A benchmark of `run(args)`, where `args = setup(data)` is called before each
+    run (not timed) and `data = prepare()` is called once. `items(data)` is the
+    number of items (e.g. questions) processed in each run, used for throughput.
+    """
+
+    def __init__(self, name, prepare, setup, run, items, unit):
+        self.name = name
+        self.prepare = prepare
+        self.setup = setup
+        self.run = run
+        self.items = items
+        self.unit = unit
+
+
+def reset_chef_state():
+    """
+    Clear the chef's in-memory caches and the chefdata/ of the working directory
+    so that each run starts cold.
+    """
+    if os.path.abspath(os.getcwd()) == REPO_DIR:
+        raise RuntimeError('Benchmarks must run in a temporary directory')
+    sushichef.configure_html_conversion_cache()
+    sushichef.COMPONENT_STORE.clear()
+    sushichef.clear_imported_nodes()
+    if os.path.exists('chefdata'):
+        shutil.rmtree('chefdata')
+
+def setup_cold(data):
+    reset_chef_state()
+    return data
+
+def setup_page(html):
+    reset_chef_state()
+    return BeautifulSoup(html, sushichef.HTML_PARSER)
+
+def setup_course(data):
+    reset_chef_state()
+    course, components = data
+    sushichef.COMPONENT_STORE.update(components)
+    return course
+
+
+def run_text_from_html(fragments):
+    for fragment in fragments:
+        sushichef.text_from_html(fragment)
+
+def run_multiple_choice_questions(questions):
+    for question in questions:
+        sushichef.question_from_edraak_MultipleChoiceQuestion(question)
+
+def run_numeric_response_questions(questions):
+    for question in questions:
+        sushichef.question_from_edraak_NumericResponseQuestion(question)
+
+def prepare_exercise():
+    return fixtures.make_exercise(random.Random(fixtures.SEED), 1, num_questions=30, image_every=4)
+
+
+BENCHMARKS = [
+    Benchmark('text_from_html',
+              prepare=fixtures.make_html_fragments,
+              setup=setup_cold,
+              run=run_text_from_html,
+              items=len, unit='fragments'),
+    Benchmark('replace_text_in_tables',
+              prepare=fixtures.make_tables_page_html,
+              setup=setup_page,
+              run=sushichef.replace_text_in_tables,
+              items=lambda html: html.count('<table'), unit='tables'),
+    Benchmark('replace_base64_images',
+              prepare=fixtures.make_images_page_html,
+              setup=setup_page,
+              run=sushichef.replace_base64_images,
+              items=lambda html: html.count('<img'), unit='images'),
+    Benchmark('question_from_edraak_MultipleChoiceQuestion',
+              prepare=lambda: fixtures.make_questions('MultipleChoiceQuestion'),
+              setup=setup_cold,
+              run=run_multiple_choice_questions,
+              items=len, unit='questions'),
+    Benchmark('question_from_edraak_NumericResponseQuestion',
+              prepare=lambda: fixtures.make_questions('NumericResponseQuestion'),
+              setup=setup_cold,
+              run=run_numeric_response_questions,
+              items=len, unit='questions'),
+    Benchmark('exercise_from_edraak_Exercise_or_Test',
+              prepare=prepare_exercise,
+              setup=setup_cold,
+              run=lambda exercise: sushichef.exercise_from_edraak_Exercise_or_Test(exercise, parent_title='Benchmark'),
+              items=lambda exercise: len(exercise['question_set']['children']), unit='questions'),
+    Benchmark('node_from_component_course',
+              prepare=fixtures.make_course,
+              setup=setup_course,
+              run=sushichef.node_from_component,
+              items=lambda data: len(data[1]), unit='components'),
+    Benchmark('get_resource_requests_from_networktab',
+              prepare=fixtures.make_networktab,
+              setup=lambda networktab: networktab,
+              run=get_resource_requests_from_networktab,
+              items=lambda networktab: len(networktab['traceEvents']), unit='events'),
+]
+
+
+def run_benchmark(benchmark, repeat=DEFAULT_REPEAT):
+    data = benchmark.prepare()
+    num_items = benchmark.items(data)
+    times = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for i in range(repeat):
+            args = benchmark.setup(data)
+            start = time.perf_counter()
+            benchmark.run(args)
+            times.append(time.perf_counter() - start)
+        args = benchmark.setup(data)
+        tracemalloc.start()
+        try:
+            benchmark.run(args)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    median_time = statistics.median(times)
+    return dict(
+        items=num_items,
+        unit=benchmark.unit,
+        median_time=median_time,
+        min_time=min(times),
+        throughput=num_items/median_time if median_time else None,
+        peak_memory=peak_memory,
+    )
+
+
+def get_environment():
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        machine=platform.machine(),
+        html_parser=sushichef.HTML_PARSER,
+    )
+
+def print_results(results):
+    print('{:46s} {:>10s} {:>22s} {:>12s}'.format('benchmark', 'median', 'throughput', 'peak memory'))
+    for name, result in results.items():
+        throughput = '{:.1f} {}/s'.format(result['throughput'], result['unit']) if result['throughput'] else '-'
+        print('{:46s} {:>9.4f}s {:>22s} {:>10.2f}MB'.format(
+            name, result['median_time'], throughput, result['peak_memory']/1e6))
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Print the change of each benchmark relative to `baseline` and return the
+    names of the benchmarks that got slower or use more memory than `threshold`.
+    """
+    if baseline['environment'] != get_environment():
+        print('WARNING: the baseline was saved in a different environment', baseline['environment'])
+    regressions = []
+    print('{:46s} {:>12s} {:>12s}'.format('benchmark', 'time', 'memory'))
+    for name, result in results.items():
+        baseline_result = baseline['results'].get(name)
+        if baseline_result is None:
+            print('{:46s} {:>12s}'.format(name, 'no baseline'))
+            continue
+        time_change = result['median_time']/baseline_result['median_time'] - 1
+        memory_change = result['peak_memory']/max(baseline_result['peak_memory'], 1) - 1
+        flags = []
+        if time_change > threshold:
+            flags.append('SLOWER')
+        elif time_change < -threshold:
+            flags.append('faster')
+        if memory_change > threshold:
+            flags.append('MORE MEMORY')
+        if 'SLOWER' in flags or 'MORE MEMORY' in flags:
+            regressions.append(name)
+        print('{:46s} {:>+11.1%} {:>+11.1%}  {}'.format(name, time_change, memory_change, ' '.join(flags)))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the chef benchmarks offline.')
+    parser.add_argument('--filter', default=None, help='Only run the benchmarks whose name contains FILTER.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Number of timed runs per benchmark.')
+    parser.add_argument('--html-parser', choices=sushichef.HTML_PARSERS, default=sushichef.HTML_PARSER)
+    parser.add_argument('--output', default=None, help='Save the results to this json file.')
+    parser.add_argument('--save-baseline', nargs='?', const=DEFAULT_BASELINE, default=None, metavar='PATH',
+                        help='Save the results as the baseline (default ' + DEFAULT_BASELINE + ').')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, default=None, metavar='PATH',
+                        help='Compare the results to the baseline and exit with status 1 on regressions.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative change considered a regression (default 0.1 = 10%%).')
+    args = parser.parse_args()
+
+    sushichef.configure_html_parser(args.html_parser)
+    work_dir = tempfile.mkdtemp(prefix='edraak-benchmarks-')
+    os.chdir(work_dir)
+    try:
+        results = {}
+        for benchmark in BENCHMARKS:
+            if args.filter and args.filter not in benchmark.name:
+                continue
+            print('Running', benchmark.name, '...', file=sys.stderr)
+            results[benchmark.name] = run_benchmark(benchmark, repeat=args.repeat)
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir)
+
+    print_results(results)
+    report = dict(
+        environment=get_environment(),
+        created_at=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        repeat=args.repeat,
+        results=results,
+    )
+    regressions = []
+    if args.compare:
+        with open(args.compare, 'r') as jsonf:
+            baseline = json.load(jsonf)
+        regressions = compare_results(results, baseline, threshold=args.threshold)
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, 'w') as jsonf:
+                json.dump(report, jsonf, indent=2, sort_keys=True)
+            print('Saved results to', path)
+    if regressions:
+        print('Regressions:', ', '.join(regressions))
+        sys.exit(1)
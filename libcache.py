@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+
+SAFE_KEY_REGEX = re.compile(r'^[A-Za-z0-9_\-]+$')
+
+# The umask can only be read by setting it, which is not thread-safe, so it is
+# read once at import time. Files written by `atomic_write` get the same mode
+# as files created with `open` (NamedTemporaryFile creates them with 0600).
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+def get_content_hash(text_or_bytes):
+    """
+    Return the sha1 hexdigest of `text_or_bytes` (str are utf-8 encoded first).
+    """
+    if not isinstance(text_or_bytes, bytes):
+        text_or_bytes = bytes(text_or_bytes, encoding='utf-8')
+    return hashlib.sha1(text_or_bytes).hexdigest()
+
+
+@contextmanager
+def atomic_write(destpath):
+    """
+    Context manager that yields a binary file object to write the contents of
+    `destpath`. The data is written to a temporary file next to `destpath` that
+    is renamed once done, so readers never see a partial file.
+    """
+    parent_dir, _ = os.path.split(destpath)
+    if parent_dir and not os.path.exists(parent_dir):
+        os.makedirs(parent_dir, exist_ok=True)
+    tmp_file = NamedTemporaryFile(dir=parent_dir or '.', prefix='.tmp', delete=False)
+    try:
+        with tmp_file:
+            yield tmp_file
+        os.chmod(tmp_file.name, FILE_MODE)
+        os.replace(tmp_file.name, destpath)
+    except BaseException:
+        if os.path.exists(tmp_file.name):
+            os.remove(tmp_file.name)
+        raise
+
+
+def write_file_atomically(destpath, text_or_bytes):
+    """
+    Write `text_or_bytes` to `destpath` atomically (see `atomic_write`), so that
+    other threads or processes never see a partial file.
+    """
+    if not isinstance(text_or_bytes, bytes):
+        text_or_bytes = bytes(text_or_bytes, encoding='utf-8')
+    with atomic_write(destpath) as f:
+        f.write(text_or_bytes)
+
+
+class JsonDiskCache(object):
+    """
+    A directory of JSON files, one file per cache key. Each entry is a dict and
+    the time it was stored is kept under `cached_at` so that entries older than
+    `ttl` seconds can be revalidated. Use `ttl=None` for entries that never expire.
+    """
+
+    def __init__(self, cache_dir, ttl=None):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def get_path(self, key):
+        """
+        Keys that are safe to use as filenames (e.g. component ids) are used as
+        is, all other keys (e.g. URLs) are hashed.
+        """
+        if SAFE_KEY_REGEX.match(key):
+            filename = key + '.json'
+        else:
+            filename = hashlib.md5(key.encode('utf-8')).hexdigest() + '.json'
+        return os.path.join(self.cache_dir, filename)
+
+    def get_entry(self, key):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as jsonf:
+                return json.load(jsonf)
+        except ValueError:
+            # corrupted entry, e.g. from a crash in older versions --- ignore it
+            return None
+
+    def set_entry(self, key, entry):
+        entry['cached_at'] = time.time()
+        write_file_atomically(self.get_path(key), json.dumps(entry, ensure_ascii=False))
+        return entry
+
+    def is_fresh(self, entry):
+        if entry is None:
+            return False
+        if self.ttl is None:
+            return True
+        return time.time() - entry.get('cached_at', 0) < self.ttl
+
+    def invalidate(self, key=None):
+        """
+        Remove the entry for `key`, or all the entries if `key` is None.
+        """
+        if key is None:
+            if os.path.exists(self.cache_dir):
+                shutil.rmtree(self.cache_dir)
+        else:
+            path = self.get_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class LRUCache(object):
+    """
+    A thread-safe in-memory cache that keeps the `maxsize` most recently used
+    entries.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,122 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_TIMEOUT = (10, 60)          # (connect, read) timeouts in seconds
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5        # sleep 0.5s, 1s, 2s, 4s, ... between retries
+DEFAULT_POOL_MAXSIZE = 10           # max number of connections per host
+# 429 responses are not retried here but returned to the caller, so that each
+# retry goes through the request scheduler, which slows down on 429s (see
+# `http_get` in sushichef.py).
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+
+class NoThrottledRetry(Retry):
+    """
+    A urllib3 `Retry` that doesn't retry 429 responses, which urllib3 otherwise
+    retries when they have a Retry-After header (see RETRY_STATUS_CODES).
+    """
+    RETRY_AFTER_STATUS_CODES = frozenset(Retry.RETRY_AFTER_STATUS_CODES - {429})
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    A `requests` transport adapter that applies a default timeout to requests
+    that don't specify one (requests waits forever by default).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.timeout = kwargs.pop('timeout', DEFAULT_TIMEOUT)
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def make_session(timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """
+    Create a `requests.Session` with a pool of keep-alive connections (at most
+    `pool_maxsize` per host, requests wait for a free connection) that retries
+    GET requests with exponential backoff on connection errors and on 5xx
+    responses.
+    """
+    retry = NoThrottledRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        backoff_factor=backoff_factor,
+        respect_retry_after_header=True,
+        raise_on_status=False,      # return the last response once retries run out
+    )
+    adapter = TimeoutHTTPAdapter(
+        timeout=timeout,
+        max_retries=retry,
+        pool_connections=pool_maxsize,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,            # otherwise extra connections are opened and discarded
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def configure_session(**kwargs):
+    """
+    Replace the shared session by one created with `make_session(**kwargs)`.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = make_session(**kwargs)
+    return _session
+
+def get_session():
+    """
+    Return the shared session used for all API and image requests.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+    return _session
+
+
+def get_connection_stats(session=None):
+    """
+    Return per-host connection-reuse counts for the connection pools of `session`:
+    `connections` is the number of TCP/TLS connections opened and `requests` is
+    the number of requests sent over them.
+    """
+    session = session or get_session()
+    stats = {}
+    seen_adapters = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen_adapters:
+            continue
+        seen_adapters.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(pool.host, dict(connections=0, requests=0))
+            host_stats['connections'] += pool.num_connections
+            host_stats['requests'] += pool.num_requests
+    for host_stats in stats.values():
+        host_stats['reused'] = max(host_stats['requests'] - host_stats['connections'], 0)
+    return stats
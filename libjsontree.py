@@ -0,0 +1,85 @@
+import json
+
+from libcache import atomic_write
+
+
+class StreamingJsonTreeWriter(object):
+    """
+    Writes the json tree `tree` (dict) to `destpath` one child at a time, so the
+    children don't need to be kept in memory until the whole tree is built:
+
+        with StreamingJsonTreeWriter(destpath, channel_dict) as writer:
+            for ...:
+                writer.add_child(child_dict)
+
+    The file written is identical to `json.dump(tree, f, indent=indent, ...)`
+    with `tree['children']` being the list of all the children added.
+    """
+
+    def __init__(self, destpath, tree, indent=2, sort_keys=False, ensure_ascii=False):
+        self.destpath = destpath
+        self.tree = tree
+        self.indent = indent
+        self.sort_keys = sort_keys
+        self.ensure_ascii = ensure_ascii
+        self.num_children = 0
+        self._atomic_write = None
+        self.file = None
+        self.keys_after_children = []
+
+    def dumps(self, obj, level):
+        """
+        Serialize `obj` as if it was nested `level` levels deep in the tree.
+        """
+        text = json.dumps(obj, indent=self.indent, sort_keys=self.sort_keys,
+                          ensure_ascii=self.ensure_ascii)
+        return text.replace('\n', '\n' + ' '*self.indent*level)
+
+    def write(self, text):
+        self.file.write(text.encode('utf-8'))
+
+    def open(self):
+        self._atomic_write = atomic_write(self.destpath)
+        self.file = self._atomic_write.__enter__()
+        keys = list(self.tree.keys())
+        if 'children' not in keys:
+            keys.append('children')
+        if self.sort_keys:
+            keys = sorted(keys)
+        children_index = keys.index('children')
+        self.keys_after_children = keys[children_index+1:]
+        self.write('{')
+        for key in keys[:children_index]:
+            self.write_key(key)
+            self.write(self.dumps(self.tree[key], 1) + ',')
+        self.write_key('children')
+        return self
+
+    def write_key(self, key):
+        self.write('\n' + ' '*self.indent + json.dumps(key, ensure_ascii=self.ensure_ascii) + ': ')
+
+    def add_child(self, child):
+        self.write('[' if self.num_children == 0 else ',')
+        self.write('\n' + ' '*self.indent*2 + self.dumps(child, 2))
+        self.num_children += 1
+
+    def close(self):
+        if self.num_children == 0:
+            self.write('[]')
+        else:
+            self.write('\n' + ' '*self.indent + ']')
+        for key in self.keys_after_children:
+            self.write(',')
+            self.write_key(key)
+            self.write(self.dumps(self.tree[key], 1))
+        self.write('\n}')
+        self._atomic_write.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._atomic_write.__exit__(exc_type, exc_value, traceback)
@@ -0,0 +1,197 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from libcache import write_file_atomically
+
+
+REPORTS_DIR = 'chefdata/reports/'
+
+
+class Metrics(object):
+    """
+    Thread-safe run metrics: the time spent in each stage of the chef and named
+    counters. Stage times are summed over all threads, and stages can be nested
+    (e.g. image downloads happen during HTML conversion), so they can add up to
+    more than the run's wall-clock time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}      # {stage: {'calls': int, 'seconds': float}}
+        self.counters = {}    # {name: int}
+        self.spans = []       # trace events in Chrome trace format (see `span`)
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            stage_stats = self.stages.setdefault(stage, dict(calls=0, seconds=0.0))
+            stage_stats['calls'] += calls
+            stage_stats['seconds'] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_span(self, event):
+        with self.lock:
+            self.spans.append(event)
+
+    def get_snapshot(self):
+        with self.lock:
+            return dict(
+                stages={stage: dict(stats) for stage, stats in self.stages.items()},
+                counters=dict(self.counters),
+                spans=list(self.spans),
+            )
+
+    def merge(self, snapshot):
+        """
+        Add the metrics `snapshot` (from `get_snapshot`) of e.g. a worker process.
+        """
+        for stage, stats in snapshot['stages'].items():
+            self.add_time(stage, stats['seconds'], calls=stats['calls'])
+        for name, value in snapshot['counters'].items():
+            self.incr(name, value)
+        with self.lock:
+            self.spans.extend(snapshot['spans'])
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.spans = []
+
+    def pop_snapshot(self):
+        with self.lock:
+            snapshot = dict(stages=self.stages, counters=self.counters, spans=self.spans)
+            self.stages = {}
+            self.counters = {}
+            self.spans = []
+        return snapshot
+
+
+# Metrics of the current process, used through the module-level functions below
+METRICS = Metrics()
+TRACING = False       # record a span for each `span` block, set by `configure_tracing`
+_run_started_at = time.time()
+
+def configure_tracing(enabled=False):
+    global TRACING
+    TRACING = enabled
+
+def timer(stage):
+    """
+    Context manager that adds the time spent in the `with` block to `stage`.
+    """
+    return METRICS.timer(stage)
+
+def add_time(stage, seconds):
+    METRICS.add_time(stage, seconds)
+
+def incr(name, value=1):
+    METRICS.incr(name, value)
+
+def get_snapshot():
+    return METRICS.get_snapshot()
+
+def pop_snapshot():
+    """
+    Return the metrics of this process and reset them, e.g. in worker processes
+    to send their metrics to the main process (see `merge`).
+    """
+    return METRICS.pop_snapshot()
+
+def merge(snapshot):
+    METRICS.merge(snapshot)
+
+@contextmanager
+def span(name, category='component', **args):
+    """
+    Context manager that records the `with` block as a span named `name` when
+    tracing is enabled. It yields the dict of the span's `args`, which the block
+    can update, e.g. with the time spent fetching data or the number of images.
+    """
+    if not TRACING:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    finally:
+        METRICS.add_span(dict(
+            name=name,
+            cat=category,
+            ph='X',                   # "complete" event with a duration
+            ts=int(start*1e6),        # microseconds
+            dur=int((time.time() - start)*1e6),
+            pid=os.getpid(),
+            tid=threading.get_ident(),
+            args=args,
+        ))
+
+def get_slowest_spans(n=20, category=None):
+    """
+    Return the `n` longest spans (of `category` if given), slowest first.
+    """
+    spans = [event for event in get_snapshot()['spans'] if category is None or event['cat'] == category]
+    return sorted(spans, key=lambda event: event['dur'], reverse=True)[:n]
+
+def write_trace(reports_dir=REPORTS_DIR):
+    """
+    Write the spans of the current run to `reports_dir` as `trace-<timestamp>.json`
+    in Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev).
+    """
+    trace = dict(traceEvents=get_snapshot()['spans'], displayTimeUnit='ms')
+    timestamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(_run_started_at))
+    trace_path = os.path.join(reports_dir, 'trace-' + timestamp + '.json')
+    write_file_atomically(trace_path, json.dumps(trace, ensure_ascii=False))
+    return trace_path
+
+
+def start_run():
+    """
+    Reset the metrics and start timing a new run.
+    """
+    global _run_started_at
+    METRICS.reset()
+    _run_started_at = time.time()
+
+
+def get_report(**extra):
+    """
+    Return the report of the current run as a dict. The `extra` keyword
+    arguments are included as is (e.g. the command line arguments).
+    """
+    report = dict(
+        started_at=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(_run_started_at)),
+        duration=round(time.time() - _run_started_at, 3),
+    )
+    report.update(get_snapshot())
+    del report['spans']   # see `write_trace`
+    for stats in report['stages'].values():
+        stats['seconds'] = round(stats['seconds'], 3)
+    report.update(extra)
+    return report
+
+def write_report(reports_dir=REPORTS_DIR, **extra):
+    """
+    Write the report of the current run to `reports_dir` as `run-<timestamp>.json`
+    and as `latest.json`, and return the path of the report.
+    """
+    report = get_report(**extra)
+    report_json = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    timestamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(_run_started_at))
+    report_path = os.path.join(reports_dir, 'run-' + timestamp + '.json')
+    write_file_atomically(report_path, report_json)
+    write_file_atomically(os.path.join(reports_dir, 'latest.json'), report_json)
+    return report_path
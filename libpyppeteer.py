@@ -1,21 +1,47 @@
 import asyncio
+from contextlib import contextmanager
 import json
 import os
-from pyppeteer import launch
 from tempfile import NamedTemporaryFile
+import threading
 
-from ricecooker.utils.downloader import read
+# pyppeteer and ricecooker are imported when a page is visited since they are
+# slow to import and not needed when the crawl results are cached
+from libscheduler import PRIORITY_BROWSER, get_scheduler
 
 
-def visit_page(url, loadjs=False, networktab=False):
+# Resource types that can be blocked when capturing requests since they are not
+# needed to run the page's javascript (see `Request.resourceType` in pyppeteer)
+BLOCKABLE_RESOURCE_TYPES = ['image', 'font', 'media']
+
+
+def visit_page(url, loadjs=False, networktab=False, capture_requests=None,
+               capture_until=None, block_resource_types=None):
     """
     Makes chromium visit the page at `url` and return the page content.
     If `networktab==True` the result will also contain the info from the network tab
     that resulted from the GET request, which can be used to find dependent resources.
+
+    Alternatively, pass a `capture_requests` function that selects requests to
+    record by listening to the browser's request events (much faster than tracing).
+    The result will contain the list of matching `requests` as {method, url} dicts,
+    and the visit stops as soon as `capture_until(requests)` returns True.
+    Requests for `block_resource_types` (e.g. BLOCKABLE_RESOURCE_TYPES) are aborted.
     """
     if not loadjs:
+        from ricecooker.utils.downloader import read
         return {'content': read(url)}
-    
+
+    capture_kwargs = dict(
+        capture_requests=capture_requests,
+        capture_until=capture_until,
+        block_resource_types=block_resource_types,
+    )
+    if _active_pool is not None:
+        return _active_pool.visit_page(url, networktab=networktab, **capture_kwargs)
+    if capture_requests:
+        networktab = False  # request events are captured instead of tracing
+
     result = {}  # dictionay {'content': str(<HTML>), 'resources':{networktabdict} }
     
     if networktab:
@@ -29,9 +55,15 @@ def visit_page(url, loadjs=False, networktab=False):
         This is the asyncio coroutine that will do the actual work.
         It is called with via `run_until_complete` below.
         """
+        from pyppeteer import launch
         browser = await launch(headless=True)
         page = await browser.newPage()
 
+        if capture_requests:
+            capture_result = await capture_page_requests(page, url, **capture_kwargs)
+            await browser.close()
+            return capture_result
+
         if networktab:
             await page.tracing.start(screenshots=True, path=networktab_file.name)
 
@@ -43,11 +75,13 @@ def visit_page(url, loadjs=False, networktab=False):
             trace = await page.tracing.stop()
 
         await browser.close()
-        return content
+        return {'content': content}
 
     # Run the async code...
     result['url'] = url  # TODO: redirects???
-    result['content'] = asyncio.get_event_loop().run_until_complete(main())
+    with get_scheduler().request(url, priority=PRIORITY_BROWSER) as slot:
+        result.update(asyncio.get_event_loop().run_until_complete(main()))
+        slot.status = 200
 
     if networktab:
         with open(networktab_file.name,'r') as jsonf:
@@ -59,6 +93,49 @@ def visit_page(url, loadjs=False, networktab=False):
 
 
 
+async def capture_page_requests(page, url, capture_requests=None, capture_until=None,
+                                block_resource_types=None, timeout=30):
+    """
+    Load `url` in `page` and record the requests selected by `capture_requests`
+    as they are sent. Returns as soon as `capture_until(requests)` is True, or
+    when the page's network is idle, or after `timeout` seconds.
+    """
+    block_resource_types = block_resource_types or []
+    captured = []
+    capture_done = asyncio.get_event_loop().create_future()
+
+    def on_request(request):
+        if block_resource_types:
+            if request.resourceType in block_resource_types:
+                asyncio.ensure_future(request.abort())
+                return
+            asyncio.ensure_future(request.continue_())
+        request_dict = dict(method=request.method, url=request.url)
+        if capture_requests is None or capture_requests(request_dict):
+            captured.append(request_dict)
+            if capture_until and not capture_done.done() and capture_until(captured):
+                capture_done.set_result(True)
+
+    if block_resource_types:
+        await page.setRequestInterception(True)
+    page.on('request', on_request)
+    navigation = asyncio.ensure_future(page.goto(url, waitUntil='networkidle0'))
+    try:
+        await asyncio.wait([navigation, capture_done], timeout=timeout,
+                           return_when=asyncio.FIRST_COMPLETED)
+        if navigation.done():
+            navigation.result()   # re-raise navigation errors
+            content = await page.content()
+        else:
+            navigation.cancel()
+            content = None        # the page was not done loading
+    finally:
+        page.remove_listener('request', on_request)
+        if block_resource_types:
+            await page.setRequestInterception(False)
+    return {'url': url, 'content': content, 'requests': captured}
+
+
 def get_resource_requests_from_networktab(networktab):
     """
     Parse `networktab` to extract only `ResourceSendRequest` information.
@@ -77,3 +154,159 @@ def get_resource_requests_from_networktab(networktab):
         )
         resource_requests.append(ne_dict)
     return resource_requests
+
+
+
+# BROWSER POOL
+################################################################################
+
+class BrowserPool(object):
+    """
+    A headless Chromium browser with `size` open tabs that stays alive so that
+    many pages can be visited without paying the browser startup cost each time.
+    Use it as a context manager:
+
+        with BrowserPool(size=4) as pool:
+            results = pool.visit_pages(urls, networktab=True)
+
+    or use the module-level `browser_pool` context manager to make `visit_page`
+    and `visit_pages` use the pool.
+    """
+
+    def __init__(self, size=4, **launch_kwargs):
+        self.size = size
+        self.launch_kwargs = dict(headless=True)
+        self.launch_kwargs.update(launch_kwargs)
+        self.loop = None
+        self.browser = None
+        self.tabs = None            # asyncio.Queue of the tabs not in use
+        self.tracing_lock = None    # Chromium can only trace one tab at a time
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self._start())
+        return self
+
+    async def _start(self):
+        from pyppeteer import launch
+        self.browser = await launch(**self.launch_kwargs)
+        self.tabs = asyncio.Queue()
+        self.tracing_lock = asyncio.Lock()
+        for i in range(self.size):
+            page = await self.browser.newPage()
+            self.tabs.put_nowait(page)
+
+    def close(self):
+        if self.loop is None:
+            return
+        if self.browser is not None:
+            self.loop.run_until_complete(self.browser.close())
+            self.browser = None
+        self.loop.close()
+        self.loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def _visit(self, url, networktab=False, **capture_kwargs):
+        """
+        Visit `url` in the next available tab, when the request scheduler allows it.
+        """
+        scheduler = get_scheduler()
+        slot = await self.loop.run_in_executor(None, scheduler.acquire, url, PRIORITY_BROWSER)
+        try:
+            result = await self._visit_in_tab(url, networktab=networktab, **capture_kwargs)
+            slot.status = 200
+            return result
+        finally:
+            scheduler.release(slot)
+
+    async def _visit_in_tab(self, url, networktab=False, **capture_kwargs):
+        """
+        Visit `url` in the next available tab. Tabs that fail are replaced.
+        """
+        page = await self.tabs.get()
+        try:
+            if capture_kwargs.get('capture_requests'):
+                return await capture_page_requests(page, url, **capture_kwargs)
+            if networktab:
+                async with self.tracing_lock:
+                    return await self._visit_with_tracing(page, url)
+            await page.goto(url, waitUntil='networkidle0')
+            content = await page.content()
+            return {'url': url, 'content': content}
+        except Exception:
+            await page.close()
+            page = await self.browser.newPage()
+            raise
+        finally:
+            self.tabs.put_nowait(page)
+
+    async def _visit_with_tracing(self, page, url):
+        networktab_file = NamedTemporaryFile(suffix='.json', delete=False)
+        networktab_file.close()
+        try:
+            await page.tracing.start(screenshots=True, path=networktab_file.name)
+            await page.goto(url, waitUntil='networkidle0')
+            content = await page.content()
+            await page.tracing.stop()
+            with open(networktab_file.name, 'r') as jsonf:
+                networktab = json.load(jsonf)
+        finally:
+            os.remove(networktab_file.name)
+        return {'url': url, 'content': content, 'networktab': networktab}
+
+    def visit_page(self, url, networktab=False, **capture_kwargs):
+        """
+        Same as the module-level `visit_page(url, loadjs=True)` but uses a tab from the pool.
+        """
+        with self.lock:
+            return self.loop.run_until_complete(self._visit(url, networktab=networktab, **capture_kwargs))
+
+    def visit_pages(self, urls, networktab=False, **capture_kwargs):
+        """
+        Visit all the `urls` in parallel tabs and return the list of results,
+        in the same order as `urls`.
+        """
+        async def visit_all():
+            visits = [self._visit(url, networktab=networktab, **capture_kwargs) for url in urls]
+            return await asyncio.gather(*visits)
+        with self.lock:
+            return self.loop.run_until_complete(visit_all())
+
+
+_active_pool = None
+
+@contextmanager
+def browser_pool(size=4, **launch_kwargs):
+    """
+    Start a `BrowserPool` that will be used by all calls to `visit_page` and
+    `visit_pages` made inside the `with` block, and shut it down afterwards.
+    """
+    global _active_pool
+    if _active_pool is not None:
+        # already inside a browser_pool block so reuse it
+        yield _active_pool
+        return
+    with BrowserPool(size=size, **launch_kwargs) as pool:
+        _active_pool = pool
+        try:
+            yield pool
+        finally:
+            _active_pool = None
+
+
+def visit_pages(urls, networktab=False, **capture_kwargs):
+    """
+    Makes chromium visit all the pages in `urls` in parallel tabs, using the
+    active `browser_pool` or a temporary one, and returns the list of results.
+    Accepts the same capture options as `visit_page`.
+    """
+    if _active_pool is not None:
+        return _active_pool.visit_pages(urls, networktab=networktab, **capture_kwargs)
+    with BrowserPool(size=min(len(urls), 4) or 1) as pool:
+        return pool.visit_pages(urls, networktab=networktab, **capture_kwargs)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Record the HTTP responses fetched during a chef run and replay them from a local
+stand-in server, e.g. to load-test the chef offline and deterministically:
+
+    ./sushichef.py --record ...                            # record a real run
+    ./libreplay.py --port 8765 --latency 0.2 --jitter 0.1 --error-rate 0.02
+    ./sushichef.py --replay=http://127.0.0.1:8765 --cache=refresh ...
+
+The stand-in server serves the recording of `https://host/path` at the url
+`http://127.0.0.1:8765/https/host/path` (see `to_replay_url`).
+"""
+import argparse
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import mimetypes
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from libcache import write_file_atomically
+
+
+RECORDINGS_DIR = 'chefdata/recordings/'
+RECORDINGS_INDEX = 'index.json'
+DEFAULT_PORT = 8765
+
+# Recordings of the requests made by a page (as captured by the browser) are
+# stored under the page url prefixed by REQUESTS_KEY_PREFIX and served from
+# the REQUESTS_PATH_PREFIX path of the stand-in server.
+REQUESTS_KEY_PREFIX = 'requests:'
+REQUESTS_PATH_PREFIX = '/_requests'
+
+
+def to_replay_url(url, replay_base_url):
+    """
+    Return the url of the recording of `url` on the server at `replay_base_url`.
+    """
+    parts = urlsplit(url)
+    replay_url = replay_base_url.rstrip('/') + '/' + parts.scheme + '/' + parts.netloc + parts.path
+    if parts.query:
+        replay_url += '?' + parts.query
+    return replay_url
+
+def to_replay_requests_url(url, replay_base_url):
+    return to_replay_url(url, replay_base_url.rstrip('/') + REQUESTS_PATH_PREFIX)
+
+def from_replay_path(path):
+    """
+    Inverse of `to_replay_url`: return the original url for the `path` requested
+    from the stand-in server, or None if `path` is not a replay path.
+    """
+    parts = path.lstrip('/').split('/', 2)
+    if len(parts) < 2 or parts[0] not in ['http', 'https']:
+        return None
+    scheme, netloc = parts[0], parts[1]
+    rest = parts[2] if len(parts) == 3 else ''
+    return scheme + '://' + netloc + '/' + rest
+
+
+class Recordings(object):
+    """
+    A directory of recorded HTTP response bodies with an index that maps each
+    url to the file containing the body and to the response status and content type.
+    """
+
+    def __init__(self, recordings_dir=RECORDINGS_DIR):
+        self.recordings_dir = recordings_dir
+        self.index_path = os.path.join(recordings_dir, RECORDINGS_INDEX)
+        self.lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as jsonf:
+                self.index = json.load(jsonf)
+        else:
+            self.index = {}
+
+    def record(self, url, body, content_type=None, status=200):
+        """
+        Save the response `body` (bytes or str) for `url`. Call `save` to write
+        the updated index once done recording.
+        """
+        content_type = content_type or 'application/octet-stream'
+        ext = mimetypes.guess_extension(content_type.split(';')[0].strip()) or ''
+        filename = hashlib.md5(url.encode('utf-8')).hexdigest() + ext
+        write_file_atomically(os.path.join(self.recordings_dir, filename), body)
+        with self.lock:
+            self.index[url] = dict(filename=filename, content_type=content_type, status=status)
+
+    def save(self):
+        with self.lock:
+            index_json = json.dumps(self.index, indent=2, sort_keys=True)
+        write_file_atomically(self.index_path, index_json)
+
+    def record_requests(self, page_url, resource_requests):
+        """
+        Save the list of requests made by the page at `page_url`.
+        """
+        self.record(REQUESTS_KEY_PREFIX + page_url, json.dumps(resource_requests),
+                    content_type='application/json')
+
+    def get(self, url):
+        """
+        Returns (status, content_type, body) of the recording for `url`, or None.
+        """
+        with self.lock:
+            info = self.index.get(url)
+        if info is None:
+            return None
+        with open(os.path.join(self.recordings_dir, info['filename']), 'rb') as f:
+            body = f.read()
+        return info['status'], info['content_type'], body
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Local HTTP stand-in for the Edraak website and API that serves `recordings`
+    after a delay of `latency` +/- `jitter` seconds, and that fails a fraction
+    `error_rate` of the requests with a 503 error. Use `seed` for reproducible
+    delays and errors.
+    """
+    daemon_threads = True
+
+    def __init__(self, recordings, host='127.0.0.1', port=DEFAULT_PORT,
+                 latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.recordings = recordings
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        ThreadingHTTPServer.__init__(self, (host, port), ReplayRequestHandler)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def draw_delay_and_error(self):
+        with self.random_lock:
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            is_error = self.random.random() < self.error_rate
+        return max(delay, 0.0), is_error
+
+    def start_in_thread(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path
+        key_prefix = ''
+        if path.startswith(REQUESTS_PATH_PREFIX + '/'):
+            path = path[len(REQUESTS_PATH_PREFIX):]
+            key_prefix = REQUESTS_KEY_PREFIX
+        url = from_replay_path(path)
+        delay, is_error = self.server.draw_delay_and_error()
+        time.sleep(delay)
+        recording = self.server.recordings.get(key_prefix + url) if url else None
+        if is_error:
+            self.send_error(503, 'Simulated error')
+        elif recording is None:
+            self.send_error(404, 'No recording for ' + str(url))
+        else:
+            status, content_type, body = recording
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # don't print a line for every request
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve recorded Edraak responses locally.')
+    parser.add_argument('--recordings-dir', default=RECORDINGS_DIR)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0, help='Response delay in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Max random variation of the delay in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail with 503.')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for delays and errors.')
+    args = parser.parse_args()
+    server = ReplayServer(Recordings(args.recordings_dir), host=args.host, port=args.port,
+                          latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, seed=args.seed)
+    print('Replaying', len(server.recordings.index), 'recordings on', server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,231 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+
+# Priorities of the chef's traffic sources, lower values go first
+PRIORITY_API = 0
+PRIORITY_IMAGE = 1
+PRIORITY_BROWSER = 2
+
+DEFAULT_RATE = 10.0             # max requests per second per host (token bucket rate)
+DEFAULT_BURST = 10              # max requests in a burst (token bucket capacity)
+DEFAULT_MAX_CONCURRENCY = 10    # max concurrent requests per host
+MIN_CONCURRENCY = 1
+THROTTLE_PAUSE = 5.0            # seconds to pause a host after a 429 without Retry-After
+LATENCY_FACTOR = 2.0            # latency this many times the best seen counts as overload
+LATENCY_EWMA_WEIGHT = 0.2
+MIN_DECREASE_INTERVAL = 0.1     # min seconds between two concurrency decreases
+
+
+class Slot(object):
+    """
+    Permission to send one request to `host`. Set `status` to the HTTP status of
+    the response (and `retry_after` if the server answered 429)
+    before releasing it, so the scheduler can adapt to the server's load.
+    """
+    def __init__(self, host, priority):
+        self.host = host
+        self.priority = priority
+        self.started_at = None
+        self.status = None
+        self.retry_after = None
+
+
+class HostLimiter(object):
+    """
+    Limits the requests sent to a single host with a token bucket (`rate` requests
+    per second, bursts of `burst` requests) and a concurrency limit that adapts
+    to the server: additive increase after each fast successful request, and
+    multiplicative decrease on 429 responses, errors, or rising latency (AIMD).
+    Waiting requests are served by priority, then in arrival order.
+    """
+
+    def __init__(self, host, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(max_concurrency/2, MIN_CONCURRENCY)
+        self.condition = threading.Condition()
+        self.waiting = []               # heap of (priority, seq)
+        self.seq = itertools.count()
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.active = 0
+        self.last_decrease = 0.0
+        self.latency_ewma = {}          # {priority: ewma of latency in seconds}
+        self.best_latency_ewma = {}     # {priority: lowest ewma seen}
+        self.stats = dict(requests=0, throttled=0, errors=0, decreases=0, wait_time=0.0)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at)*self.rate)
+        self.refilled_at = now
+
+    def acquire(self, priority):
+        start = time.monotonic()
+        with self.condition:
+            entry = (priority, next(self.seq))
+            heapq.heappush(self.waiting, entry)
+            while True:
+                if self.waiting[0] == entry and self.active < math.floor(self.concurrency):
+                    now = time.monotonic()
+                    self.refill(now)
+                    wait_time = self.paused_until - now
+                    if wait_time <= 0:
+                        if self.tokens >= 1:
+                            break
+                        wait_time = (1 - self.tokens)/self.rate
+                    self.condition.wait(wait_time)
+                else:
+                    self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.active += 1
+            self.stats['wait_time'] += time.monotonic() - start
+            self.condition.notify_all()     # the next waiting request may go too
+
+    def release(self, slot):
+        now = time.monotonic()
+        latency = now - slot.started_at
+        with self.condition:
+            self.active -= 1
+            self.stats['requests'] += 1
+            if slot.status == 429:
+                self.stats['throttled'] += 1
+                self.paused_until = max(self.paused_until, now + (slot.retry_after or THROTTLE_PAUSE))
+                self.decrease(now, slot.priority)
+            elif slot.status is None or slot.status >= 500:
+                self.stats['errors'] += 1
+                self.decrease(now, slot.priority)
+            elif self.is_latency_rising(slot.priority, latency):
+                self.decrease(now, slot.priority)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1/self.concurrency)
+            self.condition.notify_all()
+
+    def is_latency_rising(self, priority, latency):
+        """
+        Update the latency average of `priority` requests and return True if it
+        is LATENCY_FACTOR times the best average seen.
+        """
+        ewma = self.latency_ewma.get(priority, latency)
+        ewma = (1 - LATENCY_EWMA_WEIGHT)*ewma + LATENCY_EWMA_WEIGHT*latency
+        self.latency_ewma[priority] = ewma
+        # the best average drifts up slowly so a lasting change of the network
+        # doesn't keep the concurrency low forever
+        best_ewma = min(self.best_latency_ewma.get(priority, ewma)*1.01, ewma)
+        self.best_latency_ewma[priority] = best_ewma
+        return ewma > LATENCY_FACTOR*best_ewma
+
+    def decrease(self, now, priority):
+        # decrease at most once per round trip, since the requests that were
+        # sent before the previous decrease can still fail
+        interval = max(MIN_DECREASE_INTERVAL, self.latency_ewma.get(priority, 0))
+        if now - self.last_decrease < interval:
+            return
+        self.concurrency = max(MIN_CONCURRENCY, self.concurrency/2)
+        self.last_decrease = now
+        self.stats['decreases'] += 1
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['concurrency'] = round(self.concurrency, 2)
+            stats['wait_time'] = round(stats['wait_time'], 3)
+            stats['latency'] = {priority: round(ewma, 3) for priority, ewma in self.latency_ewma.items()}
+        return stats
+
+
+class Scheduler(object):
+    """
+    Schedules the requests of all the chef's traffic sources (API, images, and
+    browser visits) with a `HostLimiter` per host:
+
+        with scheduler.request(url, priority=PRIORITY_API) as slot:
+            response = session.get(url)
+            slot.status = response.status_code
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def get_settings(self):
+        return dict(rate=self.rate, burst=self.burst, max_concurrency=self.max_concurrency)
+
+    def get_limiter(self, host):
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(host, rate=self.rate, burst=self.burst,
+                                                  max_concurrency=self.max_concurrency)
+            return self.limiters[host]
+
+    def acquire(self, url, priority=PRIORITY_API):
+        """
+        Wait until a request to `url` can be sent and return its `Slot`.
+        """
+        host = urlsplit(url).netloc
+        slot = Slot(host, priority)
+        self.get_limiter(host).acquire(priority)
+        slot.started_at = time.monotonic()
+        return slot
+
+    def release(self, slot):
+        self.get_limiter(slot.host).release(slot)
+
+    @contextmanager
+    def request(self, url, priority=PRIORITY_API):
+        slot = self.acquire(url, priority=priority)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def get_stats(self):
+        with self.lock:
+            limiters = list(self.limiters.values())
+        return {limiter.host: limiter.get_stats() for limiter in limiters}
+
+
+def split_settings(settings, num_processes):
+    """
+    Divide the limits of the scheduler `settings` between `num_processes`
+    processes, so that together they don't exceed the limits.
+    """
+    return dict(
+        rate=settings['rate']/num_processes,
+        burst=max(1, settings['burst']//num_processes),
+        max_concurrency=max(MIN_CONCURRENCY, settings['max_concurrency']//num_processes),
+    )
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def configure_scheduler(**kwargs):
+    """
+    Replace the shared scheduler by one created with `Scheduler(**kwargs)`.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = Scheduler(**kwargs)
+    return _scheduler
+
+def get_scheduler():
+    """
+    Return the scheduler shared by all the requests of this process.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+    return _scheduler
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
+import argparse
 import base64
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import hashlib
+from io import BytesIO
+from html import unescape
 import json
+import mimetypes
 import os
-from PIL import Image
 import re
-import requests
-from requests.exceptions import HTTPError, ConnectionError
+import sys
+import threading
+import time
 
 from urllib.parse import urljoin
 
@@ -19,18 +23,23 @@ from urllib.parse import urljoin
 
 from le_utils.constants import content_kinds, exercises, file_types, licenses, roles
 from le_utils.constants.languages import getlang  # see also getlang_by_name, getlang_by_alpha2
-from ricecooker.chefs import JsonTreeChef
-from ricecooker.classes.licenses import get_license
-from ricecooker.utils.jsontrees import write_tree_to_json_tree
 
 
-from ricecooker.config import LOGGER
+# Heavy dependencies (ricecooker, bs4, PIL, html2text, requests, and pyppeteer)
+# are imported in the functions that use them, so that importing this module
+# (e.g. in benchmarks and worker processes) and short runs start quickly.
 import logging
+LOGGER = logging.getLogger()     # same as `from ricecooker.config import LOGGER`
 LOGGER.setLevel(logging.INFO)
 
 
-from html2text import html2text
-from libpyppeteer import visit_page, get_resource_requests_from_networktab
+from libcache import JsonDiskCache, LRUCache, atomic_write, get_content_hash, write_file_atomically
+import libmetrics
+import libscheduler
+from libjsontree import StreamingJsonTreeWriter
+from libpyppeteer import browser_pool, visit_page, visit_pages
+from libpyppeteer import BLOCKABLE_RESOURCE_TYPES
+from libreplay import Recordings, to_replay_url, to_replay_requests_url
 
 
 
@@ -42,13 +51,23 @@ DEBUG_MODE = True
 ################################################################################
 EDRAAK_DOMAIN = 'edraak.org'
 EDRAAK_CHANNEL_DESCRIPTION = """إدراك هي إحدى مبادرات مؤسسة الملكة رانيا في الأردن وهي منصة تزود المتعلمين في المراحل الأساسية والإعدادية والثانوية بدروس مصورة ملحوقة بتمارين تساعدهم في تقدمهم الأكاديمي داخل المدرسة. ومع أنّ المحتوى يتناسب مع المنهاج الوطني الأردني إلا أنه يتناسب أيضا مع كثير من المناهج الدراسية في دول المنطقة الأخرى."""
-EDRAAK_LICENSE = get_license(licenses.CC_BY_NC_SA, copyright_holder='Edraak').as_dict()
+EDRAAK_LICENSE = None   # see get_edraak_license
 EDRAAK_MAIN_CONTENT_COMPONENT_ID = '5a6087f46380a6049b33fc19'
 
 EXERCISE_IMAGES_DIR = 'chefdata/exerciseimages/'
 EXERCISE_DOWNLOADED_IMAGES_DIR = 'chefdata/downloadedimages/'
 EXERCISE_IMAGE_MAX_WIDTH = 500
 
+def get_edraak_license():
+    """
+    Return the license of the Edraak content as a dict (created on first use).
+    """
+    global EDRAAK_LICENSE
+    if EDRAAK_LICENSE is None:
+        from ricecooker.classes.licenses import get_license
+        EDRAAK_LICENSE = get_license(licenses.CC_BY_NC_SA, copyright_holder='Edraak').as_dict()
+    return EDRAAK_LICENSE
+
 class UnsupportedMarkdowSyntaxError(Exception):
     """
     This exception is raised when the chef encounters HTML tables with `colspan`
@@ -81,18 +100,128 @@ EDRAAK_SELECTED_COURSES = [
 
 
 
+# HTTP
+################################################################################
+
+# Set by --record to save all the responses in RECORDINGS (see libreplay.py) and
+# by --replay=<base_url> to get all responses from a local stand-in server.
+# Components and images served from the on-disk caches are recorded too, and
+# the crawl doesn't use the page cache and the parent ids index when recording,
+# so that the recording is complete even when the caches are warm.
+RECORDINGS = None
+REPLAY_BASE_URL = None
+THROTTLED_RETRIES = 5     # number of times to retry requests answered with 429 (--http-retries)
+
+def configure_record_replay(record=False, replay_base_url=None):
+    global RECORDINGS, REPLAY_BASE_URL
+    RECORDINGS = Recordings() if record else None
+    REPLAY_BASE_URL = replay_base_url
+
+def configure_http_retries(retries=THROTTLED_RETRIES):
+    global THROTTLED_RETRIES
+    THROTTLED_RETRIES = retries
+
+def http_get(url, priority=libscheduler.PRIORITY_API, **kwargs):
+    """
+    GET `url` using the shared HTTP session (or from the replay server), when
+    the request scheduler allows it. Requests with a lower `priority` go first.
+    Requests answered with 429 are retried here rather than by the session, so
+    that the scheduler slows down all the requests to the host (and waits for
+    the Retry-After time) before the retry.
+    """
+    import libhttp
+    request_url = to_replay_url(url, REPLAY_BASE_URL) if REPLAY_BASE_URL else url
+    for attempt in range(THROTTLED_RETRIES + 1):
+        with libscheduler.get_scheduler().request(request_url, priority=priority) as slot:
+            response = libhttp.get_session().get(request_url, **kwargs)
+            slot.status = response.status_code
+            slot.retry_after = get_retry_after(response)
+        if response.status_code != 429:
+            break
+        libmetrics.incr('http_throttled')
+    libmetrics.incr('http_requests')
+    libmetrics.incr('http_bytes', len(response.content))
+    if response.status_code >= 400:
+        libmetrics.incr('http_errors')
+    if RECORDINGS is not None and response.status_code == 200:
+        RECORDINGS.record(url, response.content, content_type=response.headers.get('Content-Type'))
+    return response
+
+
+def get_retry_after(response):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return None
+
+
+
+
 # CRAWLING
 ################################################################################
 START_URL = 'https://www.edraak.org/k12/'
 CRAWLING_STAGE_OUTPUT = 'chefdata/trees/web_resource_tree.json'
+CRAWLING_BROWSER_TABS = 4     # number of pages the headless browser loads in parallel
+
+# Cache of the HTML of the topic pages visited and the component urls discovered
+# in them during the crawl, keyed by page url. Entries expire after --page-cache-ttl
+# hours and changes to the pages are not detected, use --invalidate-page-cache to
+# clear the cache.
+PAGE_CACHE_DIR = 'chefdata/cache/pages/'
+PAGE_CACHE_TTL = 30*24*3600
+PAGE_CACHE = JsonDiskCache(PAGE_CACHE_DIR, ttl=PAGE_CACHE_TTL)
 
-def get_page(url, loadjs=False, networktab=False):
+def configure_page_cache(ttl=PAGE_CACHE_TTL):
+    global PAGE_CACHE
+    PAGE_CACHE = JsonDiskCache(PAGE_CACHE_DIR, ttl=ttl)
+
+def invalidate_page_cache(url=None):
+    """
+    Remove the cached page and discovered component url for `url` (or all pages
+    and the parent ids index).
+    """
+    PAGE_CACHE.invalidate(url)
+    if url is None:
+        clear_parent_ids_index()
+
+def get_cached_page_data(url, key):
+    if RECORDINGS is not None:
+        return None   # the page cache doesn't keep the requests made by the page
+    entry = PAGE_CACHE.get_entry(url)
+    if PAGE_CACHE.is_fresh(entry) and entry.get(key) is not None:
+        libmetrics.incr('page_cache_hits')
+        return entry[key]
+    libmetrics.incr('page_cache_misses')
+    return None
+
+def set_cached_page_data(url, key, value):
+    entry = PAGE_CACHE.get_entry(url) or dict(url=url)
+    entry[key] = value
+    PAGE_CACHE.set_entry(url, entry)
+
+
+def get_page(url, loadjs=False, networktab=False, cache=True):
     """
     Download `url` (following redirects) and soupify response contents.
     Returns (final_url, page) where final_url is URL afrer following redirects.
+    Use `cache=False` for pages that must always be downloaded.
     """
-    result = visit_page(url, loadjs=loadjs, networktab=networktab)
-    html = result['content']
+    cache_key = 'content_js' if loadjs else 'content'
+    html = None if networktab or not cache else get_cached_page_data(url, cache_key)
+    if html is None:
+        if loadjs and not REPLAY_BASE_URL:
+            with libmetrics.timer('browser_render'):
+                result = visit_page(url, loadjs=loadjs, networktab=networktab)
+            html = result['content']
+            if RECORDINGS is not None:
+                RECORDINGS.record(url, html, content_type='text/html; charset=utf-8')
+        else:
+            html = http_get(url).content
+        from bs4 import UnicodeDammit
+        html = UnicodeDammit(html, ['utf-8']).unicode_markup
+        if cache:
+            set_cached_page_data(url, cache_key, html)
+    from bs4 import BeautifulSoup
     page = BeautifulSoup(html, "html.parser")
     return page
 
@@ -110,8 +239,9 @@ def scrape_topics(url):
     """
     Get course links from page 'https://www.edraak.org/k12/'
     The Edraak website calls the different courses topic, e.g. STATS, ALGEBRA, CALC, etc.
+    The page is not cached so that new topics are found on every crawl.
     """
-    page = get_page(url)
+    page = get_page(url, cache=False)
     subject_name = get_text(page.find('div', class_="subject"))
     topics_div = page.find('div', class_="topics")
     topics = []
@@ -132,14 +262,16 @@ def scrape_topics(url):
 
 def write_web_resource_tree_json(channel_dict):
     destpath = CRAWLING_STAGE_OUTPUT
-    parent_dir, _ = os.path.split(destpath)
-    if not os.path.exists(parent_dir):
-        os.makedirs(parent_dir, exist_ok=True)
-    with open(destpath, 'w') as wrt_file:
-        json.dump(channel_dict, wrt_file, indent=2, sort_keys=True)
+    with StreamingJsonTreeWriter(destpath, channel_dict, sort_keys=True, ensure_ascii=True) as writer:
+        for child in channel_dict['children']:
+            writer.add_child(child)
 
 
 def build_web_resource_tree(start_url):
+    with libmetrics.timer('crawl'):
+        return _build_web_resource_tree(start_url)
+
+def _build_web_resource_tree(start_url):
     channel_dict = dict(
         title='Edraak Channel',
         url=start_url,
@@ -153,18 +285,22 @@ def build_web_resource_tree(start_url):
     channel_dict['children'].append(math_dict)
     
     topics = scrape_topics(start_url)
-    for topic in topics:
-        print('GET', topic['url'])
+    topic_urls = [topic['url'] for topic in topics]
+    child_component_urls = get_child_component_urls_from_urls(topic_urls)
+    for topic, child_component_url in zip(topics, child_component_urls):
         topic_dict = dict(
             title=topic['title'],
             url=topic['url'],
             thumbnail_url=topic['thumbnail_url'],
             children=[],
         )
-        topic_dict['root_component_id'] = get_course_root_component_id(topic['url'])
+        topic_dict['root_component_id'] = get_course_root_component_id(
+            topic['url'], child_component_url=child_component_url)
         math_dict['children'].append(topic_dict)
 
     write_web_resource_tree_json(channel_dict)
+    if RECORDINGS is not None:
+        RECORDINGS.save()
     return channel_dict
 
 
@@ -172,36 +308,121 @@ def build_web_resource_tree(start_url):
 # WEBSITE SCRAPING
 ################################################################################
 
-def get_course_root_component_id(url):
+# Index {component_id: parent_id} shared by all calls to `get_course_root_component_id`
+# and saved to disk so that later crawls don't need to re-fetch the ancestors.
+# Like the page cache, the index expires after --page-cache-ttl hours (counted
+# from when it was created, so that moved topics are eventually found) and is
+# cleared by --invalidate-page-cache.
+PARENT_IDS_INDEX_PATH = 'chefdata/cache/parent_ids.json'
+PARENT_IDS_INDEX = None
+PARENT_IDS_INDEX_CREATED_AT = None
+
+def get_parent_ids_index():
+    global PARENT_IDS_INDEX, PARENT_IDS_INDEX_CREATED_AT
+    if PARENT_IDS_INDEX is None:
+        PARENT_IDS_INDEX, PARENT_IDS_INDEX_CREATED_AT = {}, time.time()
+        if os.path.exists(PARENT_IDS_INDEX_PATH):
+            with open(PARENT_IDS_INDEX_PATH, 'r') as jsonf:
+                saved_index = json.load(jsonf)
+            # indexes saved by older versions have no `created_at` and are dropped
+            if PAGE_CACHE.is_fresh(dict(cached_at=saved_index.get('created_at', 0))):
+                PARENT_IDS_INDEX = saved_index['parent_ids']
+                PARENT_IDS_INDEX_CREATED_AT = saved_index['created_at']
+    return PARENT_IDS_INDEX
+
+def save_parent_ids_index():
+    index = get_parent_ids_index()
+    saved_index = dict(created_at=PARENT_IDS_INDEX_CREATED_AT, parent_ids=index)
+    write_file_atomically(PARENT_IDS_INDEX_PATH, json.dumps(saved_index, indent=2, sort_keys=True))
+
+def clear_parent_ids_index():
+    global PARENT_IDS_INDEX, PARENT_IDS_INDEX_CREATED_AT
+    PARENT_IDS_INDEX, PARENT_IDS_INDEX_CREATED_AT = None, None
+    if os.path.exists(PARENT_IDS_INDEX_PATH):
+        os.remove(PARENT_IDS_INDEX_PATH)
+
+
+def get_course_root_component_id(url, child_component_url=None):
     """
     Find the child `component_url` that gets loaded when visiting `url` and walk
     up the component hierarchy until we find the root `component_id` of the course.
+    Parent ids are looked up in the parent ids index when known, so only the
+    ancestors not seen before are fetched from the API.
     """
-    child_component_url = get_child_component_url_from_url(url)
+    if child_component_url is None:
+        child_component_url = get_child_component_url_from_url(url)
+    index = get_parent_ids_index()
 
-    component_ids = []
-    def follow_up(c):
-        component_ids.append(c['id'])
-        parent_id = c['parent_id']
-        if parent_id:
+    topic_item = get_component_from_url(child_component_url)
+    index[topic_item['id']] = topic_item['parent_id']
+    component_ids = [topic_item['id']]
+    parent_id = topic_item['parent_id']
+    while parent_id:
+        if parent_id in component_ids:
+            raise ValueError('Cycle in component hierarchy at id=' + parent_id)
+        component_ids.append(parent_id)
+        if parent_id not in index or RECORDINGS is not None:
             parent = get_component_from_id(parent_id)
-            follow_up(parent)
+            index[parent_id] = parent['parent_id']
+        parent_id = index[parent_id]
+    save_parent_ids_index()
 
-    topic_item = get_component_from_url(child_component_url)
-    follow_up(topic_item)
     assert component_ids[-1] == EDRAAK_MAIN_CONTENT_COMPONENT_ID, 'did not find child of Main Content!'
     return component_ids[-2]  # return the component_id of the course root node
 
 
+def is_component_request(resource_request):
+    return 'api/component' in resource_request['url']
+
+def found_child_component_request(component_requests):
+    # the second api/component request is the one we're looking for (see below)
+    return len(component_requests) >= 2
+
 def get_child_component_url_from_url(url):
     """
-    Downloads the website page at `url` and watches the network tab to
+    Downloads the website page at `url` and watches the network requests to
     extract the `component_url` of the form `/api/component/{component_id}/`.
     This `component_url` corresponds to a the (first) child node within a course.
     """
-    result = visit_page(url, loadjs=True, networktab=True)
-    networktab = result['networktab']
-    resource_requests = get_resource_requests_from_networktab(networktab)
+    return get_child_component_urls_from_urls([url])[0]
+
+
+def get_child_component_urls_from_urls(urls):
+    """
+    Same as `get_child_component_url_from_url` for a list of `urls`. Component
+    urls found in the page cache are reused and the other pages are loaded in
+    parallel browser tabs (the browser is not started if all urls are cached).
+    """
+    child_component_urls = {}
+    for url in urls:
+        child_component_urls[url] = get_cached_page_data(url, 'child_component_url')
+    missing_urls = [url for url in urls if child_component_urls[url] is None]
+    if missing_urls and REPLAY_BASE_URL:
+        import libhttp
+        for url in missing_urls:
+            replay_requests_url = to_replay_requests_url(url, REPLAY_BASE_URL)
+            resource_requests = libhttp.get_session().get(replay_requests_url).json()
+            child_component_urls[url] = get_child_component_url_from_resource_requests(url, resource_requests)
+    elif missing_urls:
+        print('GET', missing_urls)
+        with libmetrics.timer('browser_render'), \
+                browser_pool(size=min(len(missing_urls), CRAWLING_BROWSER_TABS)):
+            results = visit_pages(missing_urls,
+                                  capture_requests=is_component_request,
+                                  capture_until=found_child_component_request,
+                                  block_resource_types=BLOCKABLE_RESOURCE_TYPES)
+        for url, result in zip(missing_urls, results):
+            child_component_url = get_child_component_url_from_resource_requests(url, result['requests'])
+            child_component_urls[url] = child_component_url
+            set_cached_page_data(url, 'child_component_url', child_component_url)
+            if RECORDINGS is not None:
+                RECORDINGS.record_requests(url, result['requests'])
+            if result['content']:   # None when the visit stopped before the page was rendered
+                set_cached_page_data(url, 'content_js', result['content'])
+    return [child_component_urls[url] for url in urls]
+
+
+def get_child_component_url_from_resource_requests(url, resource_requests):
     components = []
     for rr in resource_requests:
         if 'api/component' in rr['url']:
@@ -229,20 +450,165 @@ def get_child_component_url_from_url(url):
 # API SCRAPING
 ################################################################################
 
+COMPONENT_URL_REGEX = re.compile(r'/api/component/(?P<component_id>[A-Za-z0-9]+)/?')
+
+# Component API responses are cached on disk, keyed by component_id. The cache
+# mode can be set from the command line using --cache=default|refresh|only
+COMPONENT_CACHE_DIR = 'chefdata/cache/components/'
+COMPONENT_CACHE_TTL = 7*24*3600           # revalidate entries older than a week
+COMPONENT_CACHE_MODES = [
+    'default',      # use fresh cache entries, revalidate stale ones with the server
+    'refresh',      # ignore the cache and re-download everything (updates cache)
+    'only',         # never hit the network; fail if a component is not in cache
+]
+COMPONENT_CACHE = JsonDiskCache(COMPONENT_CACHE_DIR, ttl=COMPONENT_CACHE_TTL)
+COMPONENT_CACHE_MODE = 'default'
+
+def configure_component_cache(mode='default', ttl=COMPONENT_CACHE_TTL):
+    global COMPONENT_CACHE, COMPONENT_CACHE_MODE
+    if mode not in COMPONENT_CACHE_MODES:
+        raise ValueError('Unknown component cache mode ' + str(mode))
+    COMPONENT_CACHE = JsonDiskCache(COMPONENT_CACHE_DIR, ttl=ttl)
+    COMPONENT_CACHE_MODE = mode
+
 def get_component_url(component_id):
     return 'https://programs.edraak.org/api/component/' + component_id + '/'
 
+def get_component_id_from_url(component_url):
+    m = COMPONENT_URL_REGEX.search(component_url)
+    if m is None:
+        raise ValueError('Not a component url ' + component_url)
+    return m.group('component_id')
+
 def get_component_from_url(component_url):
+    """
+    Return the component data from the Edraak API at `component_url`, using the
+    on-disk component cache and conditional requests (ETag/Last-Modified) to
+    avoid re-downloading components that have not changed.
+    """
+    component_id = get_component_id_from_url(component_url)
+    entry = COMPONENT_CACHE.get_entry(component_id)
+    if entry and COMPONENT_CACHE_MODE == 'only':
+        libmetrics.incr('component_cache_hits')
+        return get_cached_component_data(component_url, entry)
+    if COMPONENT_CACHE_MODE == 'only':
+        raise ValueError('Component ' + component_id + ' not found in cache (--cache=only)')
+    if COMPONENT_CACHE_MODE == 'default' and COMPONENT_CACHE.is_fresh(entry):
+        libmetrics.incr('component_cache_hits')
+        return get_cached_component_data(component_url, entry)
+    with libmetrics.timer('api_fetch'):
+        return fetch_component(component_id, component_url, entry)
+
+def fetch_component(component_id, component_url, entry):
+    """
+    Download the component at `component_url` (revalidating the cache `entry`).
+    """
+
+    headers = {}
+    if entry and COMPONENT_CACHE_MODE == 'default':
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
     # print('GET', component_url)
-    response = requests.get(component_url)
+    response = http_get(component_url, headers=headers)
+    if response.status_code == 304:
+        libmetrics.incr('component_cache_revalidated')
+        COMPONENT_CACHE.set_entry(component_id, entry)   # refresh cached_at
+        return get_cached_component_data(component_url, entry)
+    libmetrics.incr('component_cache_misses')
+    response.raise_for_status()
     component = response.json()
+    COMPONENT_CACHE.set_entry(component_id, dict(
+        url=component_url,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified'),
+        content_hash=get_content_hash(response.content),
+        data=component,
+    ))
     return component
 
+def get_cached_component_data(component_url, entry):
+    """
+    Return the component data of the cache `entry`, recording it with --record.
+    """
+    if RECORDINGS is not None:
+        RECORDINGS.record(component_url, json.dumps(entry['data'], ensure_ascii=False),
+                          content_type='application/json')
+    return entry['data']
+
 def get_component_from_id(component_id):
+    if component_id in COMPONENT_STORE:
+        return COMPONENT_STORE[component_id]
     component_url = get_component_url(component_id)
     return get_component_from_url(component_url)
 
 
+# PREFETCH
+################################################################################
+
+# In-memory store of the leaf components of the course being processed, which
+# is filled by `prefetch_components` before running the tree transform.
+COMPONENT_STORE = {}
+COMPONENT_FETCH_TIMES = {}   # {component_id: seconds} spent fetching the prefetched components
+
+# Number of threads used to prefetch the components and images of each course.
+# The request scheduler limits the number of concurrent requests to each host.
+PREFETCH_WORKERS = 10
+
+def configure_prefetch(workers=PREFETCH_WORKERS):
+    global PREFETCH_WORKERS
+    PREFETCH_WORKERS = workers
+
+def get_leaf_component_ids(component, is_finished=None):
+    """
+    Return the ids of all the Video, Exercise, and Test components in the
+    `children` hierarchy of `component` (including imported components).
+    Subtrees for which `is_finished(component, parent_title)` is True are skipped.
+    """
+    leaf_ids = []
+    seen_ids = set()
+    stack = [(component, None)]
+    while stack:
+        component, parent_title = stack.pop()
+        component_type = component['component_type']
+        if component_type == 'ImportedComponent':
+            stack.append((component['target_component'], None))
+        elif is_finished and is_finished(component, parent_title):
+            continue
+        elif component_type in LEAF_CONTENT_TYPES:
+            if component['id'] not in seen_ids:
+                seen_ids.add(component['id'])
+                leaf_ids.append(component['id'])
+        else:
+            title = component['title'].strip() if 'title' in component else None
+            for child in reversed(component.get('children', [])):
+                stack.append((child, title))
+    return leaf_ids
+
+def prefetch_components(component_ids, max_workers=1):
+    """
+    Fetch all the components in `component_ids` into the `COMPONENT_STORE` using
+    a pool of `max_workers` threads. Returns the number of components fetched.
+    """
+    missing_ids = [cid for cid in component_ids if cid not in COMPONENT_STORE]
+    component_urls = [get_component_url(cid) for cid in missing_ids]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(get_component_from_url_timed, component_urls)
+        for component_id, (component, fetch_time) in zip(missing_ids, results):
+            COMPONENT_STORE[component_id] = component
+            COMPONENT_FETCH_TIMES[component_id] = fetch_time
+    return len(missing_ids)
+
+def get_component_from_url_timed(component_url):
+    """
+    Returns (component, seconds) where `seconds` is the time spent fetching it.
+    """
+    start = time.time()
+    component = get_component_from_url(component_url)
+    return component, time.time() - start
+
+
 
 
 
@@ -271,7 +637,7 @@ def exercise_from_edraak_Exercise_or_Test(exercise, parent_title=None, istest=Fa
         source_id=exercise['id'],
         description=exercise['id'] if DEBUG_MODE else '',
         language=getlang('ar').code,
-        license=EDRAAK_LICENSE,
+        license=get_edraak_license(),
         exercise_data={
             'mastery_model': exercises.M_OF_N,
             'randomize': False,
@@ -286,26 +652,16 @@ def exercise_from_edraak_Exercise_or_Test(exercise, parent_title=None, istest=Fa
     # Add questions to exercise node
     question_set = exercise['question_set']
     question_set_children = question_set['children']
-    questions = []
-    for question in question_set_children:
-        try:
-            component_type = question['component_type']
-            if question['id'] in EDRAAK_SKIP_COMPONENT_IDS:
-                continue
-
-            if component_type == 'MultipleChoiceQuestion':
-                question_dict = question_from_edraak_MultipleChoiceQuestion(question)
-                if question_dict:
-                    questions.append(question_dict)
-
-            elif component_type == 'NumericResponseQuestion':
-                question_dict = question_from_edraak_NumericResponseQuestion(question)
-                if question_dict:
-                    questions.append(question_dict)
-            else:
-                print('skipping component_type', component_type)
-        except UnsupportedMarkdowSyntaxError:
-            LOGGER.warning('Skipping question ' + question['id'] + ' in exercise id=' + exercise['id'])
+    exercise_ids = [exercise['id']]*len(question_set_children)
+    if QUESTION_PROCESS_POOL is not None:
+        results = QUESTION_PROCESS_POOL.map(question_from_edraak_question_in_worker, question_set_children, exercise_ids)
+        question_dicts = []
+        for question_dict, metrics_snapshot in results:
+            libmetrics.merge(metrics_snapshot)
+            question_dicts.append(question_dict)
+    else:
+        question_dicts = map(question_from_edraak_question, question_set_children, exercise_ids)
+    questions = [question_dict for question_dict in question_dicts if question_dict]
 
     if questions:
         exercise_dict['questions'] = questions
@@ -317,6 +673,100 @@ def exercise_from_edraak_Exercise_or_Test(exercise, parent_title=None, istest=Fa
         return None
 
 
+def question_from_edraak_question(question, exercise_id):
+    """
+    Convert the Edraak `question` to a Kolibri question dict, or return None if
+    the question must be skipped. Runs in a worker process when using --processes.
+    """
+    component_type = question['component_type']
+    with libmetrics.span(question['id'], 'question', component_type=component_type,
+                         exercise_id=exercise_id) as span_args:
+        question_dict = convert_question(question, exercise_id)
+        span_args['image_count'] = get_node_image_count(question_dict)
+        if libmetrics.TRACING:
+            span_args['size'] = len(json.dumps(question))   # e.g. to spot huge base64 images
+    if question_dict is None:
+        libmetrics.incr('questions_skipped')
+    return question_dict
+
+def convert_question(question, exercise_id):
+    try:
+        component_type = question['component_type']
+        if question['id'] in EDRAAK_SKIP_COMPONENT_IDS:
+            return None
+
+        if component_type == 'MultipleChoiceQuestion':
+            return question_from_edraak_MultipleChoiceQuestion(question)
+
+        elif component_type == 'NumericResponseQuestion':
+            return question_from_edraak_NumericResponseQuestion(question)
+        else:
+            print('skipping component_type', component_type)
+    except UnsupportedMarkdowSyntaxError:
+        LOGGER.warning('Skipping question ' + question['id'] + ' in exercise id=' + exercise_id)
+    return None
+
+def question_from_edraak_question_in_worker(question, exercise_id):
+    """
+    Same as `question_from_edraak_question` but also returns the metrics of the
+    conversion, for `question_from_edraak_question` in worker processes.
+    """
+    question_dict = question_from_edraak_question(question, exercise_id)
+    return question_dict, libmetrics.pop_snapshot()
+
+
+# Pool of processes used to convert questions in parallel, set by --processes
+QUESTION_PROCESS_POOL = None
+
+def get_worker_settings():
+    """
+    Settings of this process that must be applied in the question worker processes.
+    """
+    return dict(
+        html_parser=HTML_PARSER,
+        persist_html_cache=HTML_CONVERSION_DISK_CACHE is not None,
+        revalidate_images=REVALIDATE_IMAGES,
+        replay_base_url=REPLAY_BASE_URL,
+        http_retries=THROTTLED_RETRIES,
+        tracing=libmetrics.TRACING,
+        scheduler=libscheduler.get_scheduler().get_settings(),
+    )
+
+def init_question_worker(settings):
+    libmetrics.start_run()   # forked workers start with a copy of the parent's metrics
+    libmetrics.configure_tracing(settings['tracing'])
+    configure_html_parser(settings['html_parser'])
+    configure_html_conversion_cache(persist=settings['persist_html_cache'])
+    configure_image_downloads(revalidate=settings['revalidate_images'])
+    configure_record_replay(replay_base_url=settings['replay_base_url'])
+    configure_http_retries(settings['http_retries'])
+    libscheduler.configure_scheduler(**settings['scheduler'])
+
+def configure_question_process_pool(processes=0):
+    """
+    Start a pool of `processes` worker processes for converting questions, or
+    shut down the current pool if `processes` is 0.
+    """
+    global QUESTION_PROCESS_POOL
+    if QUESTION_PROCESS_POOL is not None:
+        QUESTION_PROCESS_POOL.shutdown()
+        QUESTION_PROCESS_POOL = None
+    if processes:
+        settings = get_worker_settings()
+        # the workers share the request limits of this process
+        settings['scheduler'] = libscheduler.split_settings(settings['scheduler'], processes)
+        QUESTION_PROCESS_POOL = ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_question_worker,
+            initargs=(settings,),
+        )
+        # Start all the workers now, from the calling thread. Otherwise the pool
+        # forks them on the first `map`, which can run in a transform thread while
+        # other threads hold locks (metrics, caches, logging) that the forked
+        # workers would then wait for forever.
+        list(QUESTION_PROCESS_POOL.map(int, range(processes)))
+
+
 def question_from_edraak_MultipleChoiceQuestion(question):
     question_md = full_description_str_from_component(question)
     question_dict = dict(
@@ -402,7 +852,7 @@ def video_from_edraak_Video(video):
         author = 'Edraak',
         description=video['id'] if DEBUG_MODE else '',
         language=getlang('ar').code,
-        license=EDRAAK_LICENSE,
+        license=get_edraak_license(),
         files=[]
     )
     file_dict = dict(
@@ -426,16 +876,84 @@ FOLDER_LIKE_CONTENTY_TYPES = [
     'OnlineLesson',
 ]
 
-def node_from_component(component, parent_title=None):
+LEAF_CONTENT_TYPES = [
+    'Video',
+    'Exercise',
+    'Test',
+]
+
+# Nodes built for the targets of ImportedComponents in the current course, so
+# that a subtree imported in several places of a course is only converted once.
+# They are cleared once the course is built, to keep only one course in memory
+# (subtrees imported by several courses are converted again for each course,
+# but their HTML conversions and images are reused).
+IMPORTED_NODES = {}   # {(component_id, parent_title): pending_node}
+IMPORTED_NODES_STATS = dict(built=0, reused=0, reused_leaves=0)   # of the current course
+
+def clear_imported_nodes():
+    IMPORTED_NODES.clear()
+    for key in IMPORTED_NODES_STATS:
+        IMPORTED_NODES_STATS[key] = 0
+
+def add_imported_nodes_stat(key, value=1):
+    IMPORTED_NODES_STATS[key] += value
+    libmetrics.incr('imported_subtrees_' + key, value)   # totals of the run
+
+class PendingTopic(object):
+    """
+    A topic node whose children may still be being fetched and converted.
+    `children` is a list of `(child_id, pending_child)` tuples, in order.
+    """
+    def __init__(self, topic_dict, children, parent_title=None, content_hash=None):
+        self.topic_dict = topic_dict
+        self.children = children
+        self.parent_title = parent_title
+        self.content_hash = content_hash   # set for incremental builds
+        self.resolved = False              # imported subtrees are resolved once
+        self.node = None
+
+
+def node_from_component(component, parent_title=None, executor=None):
+    """
+    Convert the Edraak `component` to a ricecooker json tree node, or None.
+    When `executor` (a `concurrent.futures.Executor`) is given, the leaf nodes
+    (Video, Exercise, and Test) are fetched and converted concurrently.
+    """
+    pending_node = pending_node_from_component(component, parent_title=parent_title, executor=executor)
+    return resolve_pending_node(pending_node)
+
+
+def pending_node_from_component(component, parent_title=None, executor=None):
+    """
+    Walk the component hierarchy and start the conversion of all leaf nodes.
+    Returns a structure of `PendingTopic`s and `Future`s to `resolve_pending_node`.
+    """
     component_type = component['component_type']
 
     # Imported components
     if component_type == 'ImportedComponent':
         target_component = component['target_component']
-        return node_from_component(target_component)
+        key = (target_component['id'], None)
+        if key in IMPORTED_NODES:
+            add_imported_nodes_stat('reused')
+            add_imported_nodes_stat('reused_leaves', len(get_leaf_component_ids(target_component)))
+            return IMPORTED_NODES[key]
+        pending_node = pending_node_from_component(target_component, executor=executor)
+        IMPORTED_NODES[key] = pending_node
+        add_imported_nodes_stat('built')
+        return pending_node
 
     # Topic nodes
     if component_type in FOLDER_LIKE_CONTENTY_TYPES:
+        found, checkpoint_node = get_checkpoint(get_node_key(component['id'], parent_title))
+        if found:
+            return checkpoint_node
+        content_hash = None
+        if NODE_CACHE is not None:
+            content_hash = get_subtree_content_hash(component, parent_title=parent_title)
+            found, previous_node = get_previous_node(component['id'], parent_title, content_hash)
+            if found:
+                return previous_node
         print('  - processing folder id=', component['id'])
         topic_dict = dict(
             kind=content_kinds.TOPIC,
@@ -443,60 +961,456 @@ def node_from_component(component, parent_title=None):
             source_id=component['id'],
             description=component['id'] if DEBUG_MODE else '',
             language=getlang('ar').code,
-            license=EDRAAK_LICENSE,
+            license=get_edraak_license(),
             children=[],
         )
-        child_source_ids = []
+        children = []
         for child in component['children']:
-            child_node = node_from_component(child, parent_title=component['title'].strip())
+            pending_child = pending_node_from_component(child, parent_title=component['title'].strip(), executor=executor)
+            children.append((child['id'], pending_child))
+        return PendingTopic(topic_dict, children, parent_title=parent_title, content_hash=content_hash)
+
+    elif component_type in LEAF_CONTENT_TYPES:
+        if executor:
+            return executor.submit(leaf_node_from_component, component, parent_title=parent_title)
+        else:
+            return leaf_node_from_component(component, parent_title=parent_title)
+
+    else:
+        print(component)
+        raise ValueError('unknown component')
+
+
+def resolve_pending_node(pending_node):
+    """
+    Wait for the leaf conversions to finish and assemble the final topic tree.
+    Empty topics are dropped and duplicate children are skipped.
+    """
+    if isinstance(pending_node, Future):
+        return pending_node.result()
+
+    if isinstance(pending_node, PendingTopic):
+        if pending_node.resolved:
+            return pending_node.node
+        topic_dict = pending_node.topic_dict
+        child_source_ids = set()
+        for child_id, pending_child in pending_node.children:
+            child_node = resolve_pending_node(pending_child)
             if child_node:
                 if child_node['source_id'] not in child_source_ids:
                     topic_dict['children'].append(child_node)
-                    child_source_ids.append(child_node['source_id'])
+                    child_source_ids.add(child_node['source_id'])
                 else:
-                    print('Skipping duplicate child with id=', child['id'])
+                    print('Skipping duplicate child with id=', child_id)
 
-        if topic_dict['children']:
-            return topic_dict
-        else:
-            return None
+        topic_node = topic_dict if topic_dict['children'] else None
+        if pending_node.content_hash:
+            save_node(topic_dict['source_id'], pending_node.parent_title, pending_node.content_hash, topic_node)
+        save_checkpoint(get_node_key(topic_dict['source_id'], pending_node.parent_title), topic_node)
+        pending_node.resolved = True
+        pending_node.node = topic_node
+        pending_node.children = None   # free the pending children
+        return topic_node
 
-    elif component_type == 'Video':
-        # print('processing video id=', component['id'])
-        component_id = component['id']
-        video = get_component_from_id(component_id)
-        video_dict = video_from_edraak_Video(video)
-        return video_dict
-
-    elif component_type == 'Exercise':
-        print('processing exercise id=', component['id'])
-        component_id = component['id']
-        exercise = get_component_from_id(component_id)
-        exercise_dict = exercise_from_edraak_Exercise_or_Test(exercise, parent_title=parent_title)
-        return exercise_dict
+    return pending_node
 
-    elif component_type == 'Test':
-        print('processing test id=', component['id'])
-        component_id = component['id']
-        test = get_component_from_id(component_id)
-        test_dict = exercise_from_edraak_Exercise_or_Test(test, parent_title=parent_title, istest=True)
-        return test_dict
 
+def leaf_node_from_component(component, parent_title=None):
+    """
+    Fetch the full data for the leaf `component` and convert it to a Kolibri node.
+    For incremental builds, the node from the previous run is reused if the
+    component did not change. When resuming, the node from the checkpoint is used.
+    """
+    checkpoint_key = get_node_key(component['id'], parent_title)
+    found, checkpoint_node = get_checkpoint(checkpoint_key)
+    if found:
+        return checkpoint_node
+    if NODE_CACHE is None:
+        leaf_node = convert_leaf_component(component, parent_title=parent_title)
     else:
+        content_hash = get_subtree_content_hash(component, parent_title=parent_title)
+        found, leaf_node = get_previous_node(component['id'], parent_title, content_hash)
+        if not found:
+            leaf_node = convert_leaf_component(component, parent_title=parent_title)
+            save_node(component['id'], parent_title, content_hash, leaf_node)
+    save_checkpoint(checkpoint_key, leaf_node)
+    return leaf_node
+
+
+def convert_leaf_component(component, parent_title=None):
+    """
+    Fetch and convert the leaf `component`, recording a tracing span for it.
+    """
+    component_type = component['component_type']
+    if component_type not in LEAF_CONTENT_TYPES:
         print(component)
         raise ValueError('unknown component')
 
+    with libmetrics.span(component['id'], 'component', component_type=component_type) as span_args:
+        if component_type == 'Video':
+            # print('processing video id=', component['id'])
+            pass
+        elif component_type == 'Exercise':
+            print('processing exercise id=', component['id'])
+        elif component_type == 'Test':
+            print('processing test id=', component['id'])
+        start = time.time()
+        component_data = get_component_from_id(component['id'])
+        # prefetched components were fetched before the transform, so report that time
+        fetch_time = COMPONENT_FETCH_TIMES.get(component['id'], time.time() - start)
+        span_args['fetch_time'] = round(fetch_time, 6)
+
+        start = time.time()
+        if component_type == 'Video':
+            node = video_from_edraak_Video(component_data)
+        else:
+            istest = component_type == 'Test'
+            node = exercise_from_edraak_Exercise_or_Test(component_data, parent_title=parent_title, istest=istest)
+        span_args['conversion_time'] = round(time.time() - start, 6)
+        span_args['image_count'] = get_node_image_count(node)
+    return node
+
+
+def get_node_image_count(node):
+    """
+    Return the number of local images (downloaded or decoded from base64) used in `node`.
+    """
+    if not node:
+        return 0
+    return len(LOCAL_IMAGE_PATH_REGEX.findall(json.dumps(node, ensure_ascii=False)))
+
+
+
+
+# INCREMENTAL BUILDS
+################################################################################
+
+# Nodes generated in previous runs, with the content hash of the components they
+# were generated from. Used when the chef is run with --incremental.
+NODE_CACHE_DIR = 'chefdata/cache/nodes/'
+NODE_CACHE = None
+TRANSFORM_VERSION = 3     # increment when the generated nodes change for the same components
+INCREMENTAL_STATS = dict(reused=0, converted=0)   # of the current course
+INCREMENTAL_STATS_LOCK = threading.Lock()         # nodes are converted in worker threads
+SUBTREE_CONTENT_HASHES = {}   # {(component_id, parent_title): content_hash} for this run
+
+LOCAL_IMAGE_PATH_REGEX = re.compile(r'chefdata/(?:exerciseimages|downloadedimages)/[^\s\)"\']+')
+REMOTE_IMAGE_REGEX = re.compile(r'!\[[^\]]*\]\(<?https?://')   # markdown images of failed downloads
+
+def configure_incremental_build(enabled=False):
+    global NODE_CACHE
+    NODE_CACHE = JsonDiskCache(NODE_CACHE_DIR) if enabled else None
+    SUBTREE_CONTENT_HASHES.clear()
+
+def clear_incremental_stats():
+    with INCREMENTAL_STATS_LOCK:
+        for key in INCREMENTAL_STATS:
+            INCREMENTAL_STATS[key] = 0
+
+def add_incremental_stat(key):
+    with INCREMENTAL_STATS_LOCK:
+        INCREMENTAL_STATS[key] += 1
+    libmetrics.incr('incremental_' + key)   # totals of the run
+
+def get_incremental_totals():
+    counters = libmetrics.get_snapshot()['counters']
+    return {key: counters.get('incremental_' + key, 0) for key in INCREMENTAL_STATS}
+
+def get_transform_settings():
+    """
+    Settings that affect the nodes generated, included in all content hashes.
+    """
+    return [TRANSFORM_VERSION, DEBUG_MODE, EDRAAK_SKIP_COMPONENT_IDS, EXERCISE_IMAGE_MAX_WIDTH, HTML_PARSER]
+
+def get_subtree_content_hash(component, parent_title=None):
+    """
+    Return a hash of all the data used to generate the node for `component`,
+    including the data of all its descendants.
+    """
+    component_type = component['component_type']
+    if component_type == 'ImportedComponent':
+        return get_subtree_content_hash(component['target_component'])
+    key = (component['id'], parent_title)
+    if key in SUBTREE_CONTENT_HASHES:
+        return SUBTREE_CONTENT_HASHES[key]
+    if component_type in FOLDER_LIKE_CONTENTY_TYPES:
+        title = component['title'].strip()
+        child_hashes = [get_subtree_content_hash(child, parent_title=title) for child in component['children']]
+        data = [component['id'], component_type, title, child_hashes]
+    else:
+        data = [parent_title, component_type, get_component_from_id(component['id'])]
+    content_hash = get_content_hash(json.dumps([get_transform_settings(), data], sort_keys=True))
+    SUBTREE_CONTENT_HASHES[key] = content_hash
+    return content_hash
+
+def get_node_key(component_id, parent_title):
+    return component_id + '|' + (parent_title or '')
+
+def images_resolved(node):
+    """
+    True if all the images of `node` are local files that exist. Images whose
+    download failed keep their http(s) src, and must be retried in the next run.
+    """
+    node_json = json.dumps(node, ensure_ascii=False)
+    if REMOTE_IMAGE_REGEX.search(node_json):
+        return False
+    return all(os.path.exists(path) for path in LOCAL_IMAGE_PATH_REGEX.findall(node_json))
+
+def get_previous_node(component_id, parent_title, content_hash):
+    """
+    Returns (found, node) where `node` is the node generated in a previous run
+    for the same `content_hash` (can be None if the component was skipped).
+    """
+    entry = NODE_CACHE.get_entry(get_node_key(component_id, parent_title))
+    if entry and entry['content_hash'] == content_hash and images_resolved(entry['node']):
+        add_incremental_stat('reused')
+        return True, entry['node']
+    return False, None
+
+def save_node(component_id, parent_title, content_hash, node):
+    add_incremental_stat('converted')
+    entry = dict(content_hash=content_hash, node=node)
+    NODE_CACHE.set_entry(get_node_key(component_id, parent_title), entry)
+
+
+
+
+# CHECKPOINTS
+################################################################################
+
+# Every course, topic, and leaf node is saved to CHECKPOINTS_DIR as soon as it
+# is built, so that an interrupted run can be continued with --resume-build.
+# The checkpoints are cleared when a run completes or starts without it.
+# (ricecooker's own --resume continues an interrupted upload instead.)
+CHECKPOINTS_DIR = 'chefdata/checkpoints/'
+CHECKPOINTS = JsonDiskCache(CHECKPOINTS_DIR)
+RESUME = False
+
+def configure_checkpoints(resume=False):
+    global RESUME
+    RESUME = resume
+
+def clear_checkpoints():
+    CHECKPOINTS.invalidate()
+
+def get_course_checkpoint_key(course_id):
+    return 'course-' + course_id
+
+def has_checkpoint(key):
+    return RESUME and os.path.exists(CHECKPOINTS.get_path(key))
+
+def is_finished_component(component, parent_title):
+    return has_checkpoint(get_node_key(component['id'], parent_title))
+
+def get_checkpoint(key):
+    """
+    Returns (found, node) where `node` was saved under `key` before the run was
+    interrupted (can be None if the component was skipped). Only used with --resume-build.
+    Nodes built with other transform settings, or with images that are missing
+    or failed to download, are built again.
+    """
+    if not RESUME:
+        return False, None
+    entry = CHECKPOINTS.get_entry(key)
+    if entry is None or entry.get('transform_settings') != get_transform_settings() \
+            or not images_resolved(entry['node']):
+        return False, None
+    libmetrics.incr('checkpoints_restored')
+    return True, entry['node']
+
+def save_checkpoint(key, node):
+    CHECKPOINTS.set_entry(key, dict(node=node, transform_settings=get_transform_settings()))
+
+
+
+
+# IMAGE DOWNLOADS
+################################################################################
+
+# Images are downloaded once to EXERCISE_DOWNLOADED_IMAGES_DIR and reused in
+# later runs. Use --revalidate-images to check if they changed on the server.
+IMAGE_CACHE_DIR = 'chefdata/cache/images/'
+IMAGE_CACHE = JsonDiskCache(IMAGE_CACHE_DIR)   # ETag and Last-Modified of images
+REVALIDATE_IMAGES = False
+IMAGE_DOWNLOADS = {}      # {url: Future} of the downloads started in this run
+IMAGE_DOWNLOADS_LOCK = threading.Lock()
+IMG_SRC_REGEX = re.compile(r'<img[^>]+src\s*=\s*["\']([^"\']+)["\']', flags=re.IGNORECASE)
+
+def configure_image_downloads(revalidate=False):
+    global REVALIDATE_IMAGES
+    REVALIDATE_IMAGES = revalidate
+
+def get_downloaded_image_path(url):
+    _, imgfilename = os.path.split(url)
+    _, ext = os.path.splitext(imgfilename)
+    if ext == '':
+        ext = '.png'
+    dfilename = get_hash_value(url) + ext
+    return os.path.join(EXERCISE_DOWNLOADED_IMAGES_DIR, dfilename)
+
+def download_image(url):
+    """
+    Download the image at `url` and return its local path, or None if the
+    download failed. Concurrent and repeated calls for the same `url` share a
+    single download, and images already on disk are not downloaded again.
+    """
+    with IMAGE_DOWNLOADS_LOCK:
+        future = IMAGE_DOWNLOADS.get(url)
+        is_new_download = future is None
+        if is_new_download:
+            future = Future()
+            IMAGE_DOWNLOADS[url] = future
+    if is_new_download:
+        try:
+            future.set_result(_download_image(url))
+        except BaseException as e:
+            future.set_exception(e)
+    return future.result()
+
+def _download_image(url):
+    with libmetrics.timer('image_download'):
+        return _download_image_to_path(url)
+
+def _download_image_to_path(url):
+    from requests.exceptions import HTTPError, ConnectionError, Timeout
+    downloadpath = get_downloaded_image_path(url)
+    headers = {}
+    if os.path.exists(downloadpath):
+        if not REVALIDATE_IMAGES:
+            libmetrics.incr('image_cache_hits')
+            return get_cached_image_path(url, downloadpath)
+        entry = IMAGE_CACHE.get_entry(url) or {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response = http_get(url, headers=headers, priority=libscheduler.PRIORITY_IMAGE)
+        if response.status_code == 304:
+            libmetrics.incr('image_cache_hits')
+            return get_cached_image_path(url, downloadpath)
+        elif response.status_code == 200:
+            libmetrics.incr('images_downloaded')
+            write_file_atomically(downloadpath, response.content)
+            IMAGE_CACHE.set_entry(url, dict(
+                url=url,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            ))
+            return downloadpath
+        else:
+            print('Problem downloading image ', url)
+    except (HTTPError, ConnectionError, Timeout) as e:
+        LOGGER.warning('Failed to download img src=' + url)
+    return None
+
+
+def get_cached_image_path(url, downloadpath):
+    """
+    Return the path of the image downloaded before, recording it with --record.
+    """
+    if RECORDINGS is not None:
+        with open(downloadpath, 'rb') as imgf:
+            RECORDINGS.record(url, imgf.read(), content_type=mimetypes.guess_type(downloadpath)[0])
+    return downloadpath
+
+
+def get_image_urls_from_html(html):
+    urls = []
+    for src in IMG_SRC_REGEX.findall(html or ''):
+        src = unescape(src)
+        if re.search('http[s]?://', src):
+            urls.append(src)
+    return urls
+
+def get_image_urls_from_component(component):
+    """
+    Return the urls of all the HTTP images in the descriptions, choices, and
+    hints of the questions in the Exercise or Test `component` (or Video).
+    """
+    htmls = [component.get('full_description')]
+    for question in component.get('question_set', {}).get('children', []):
+        htmls.append(question.get('full_description'))
+        for choice in question.get('choices', []):
+            htmls.append(choice.get('description'))
+        for hint in question.get('hints', []):
+            htmls.append(hint.get('description'))
+    urls = []
+    for html in htmls:
+        urls.extend(get_image_urls_from_html(html))
+    return urls
+
+def prefetch_images(urls, max_workers=1):
+    """
+    Download all the images at `urls` (skipping duplicates) using a pool of
+    `max_workers` threads. Returns the number of unique urls.
+    """
+    unique_urls = list(OrderedDict.fromkeys(urls))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(download_image, unique_urls))
+    return len(unique_urls)
+
 
 
 
 # IMG TRANSFORMS
 ################################################################################
 
-BASE64_REGEX_STR = r'data:image\/([A-Za-z\+]*);base64,((?:[A-Za-z0-9+\/]{4})*(?:[A-Za-z0-9+\/]{2}==|[A-Za-z0-9+\/]{3}=)*)'
-BASE64_REGEX = re.compile(BASE64_REGEX_STR, flags=re.IGNORECASE)
+# Linear-time parsing of base64 image data URIs (a single regex for the whole
+# data URI can backtrack on long payloads)
+DATA_URI_REGEX = re.compile(r'data:image/([A-Za-z0-9.+\-]*);base64,', flags=re.IGNORECASE)
+BASE64_PAYLOAD_REGEX = re.compile(r'[A-Za-z0-9+/]*')
+DATA_URI_CHUNK_SIZE = 64*1024    # must be a multiple of 4 to decode base64 in chunks
+IMAGE_SUBTYPE_EXTENSIONS = {
+    'svg+xml': '.svg',
+    'png': '.png',
+    'jpeg': '.jpg',
+    'jpg': '.jpg',
+    'gif': '.gif',
+    'webp': '.webp',
+    'bmp': '.bmp',
+}
+
+def parse_base64_image_data_uri(text):
+    """
+    Find the first base64 image data URI in `text` without copying its payload.
+    Returns (subtype, start, end) where `text[start:end]` is the base64 payload
+    (complete 4-character groups and padding), or None if not found.
+    """
+    m = DATA_URI_REGEX.search(text)
+    if m is None:
+        return None
+    start = m.end()
+    end = BASE64_PAYLOAD_REGEX.match(text, start).end()
+    remainder = (end - start) % 4
+    if remainder in [2, 3] and text.startswith('=' * (4 - remainder), end):
+        end += 4 - remainder    # padding
+    else:
+        end -= remainder        # ignore incomplete trailing group
+    return m.group(1).lower(), start, end
 
-def get_base64_encoding(text):
-    return BASE64_REGEX.search(text)
+def get_image_extension(subtype):
+    if subtype in IMAGE_SUBTYPE_EXTENSIONS:
+        return IMAGE_SUBTYPE_EXTENSIONS[subtype]
+    ext = mimetypes.guess_extension('image/' + subtype)
+    return ext or '.' + re.sub('[^a-z0-9]', '', subtype)
+
+def get_data_uri_payload_hash(text, start, end):
+    """
+    Same as `get_hash_value(text[start:end])` but hashes the payload in chunks.
+    """
+    hashobj = hashlib.md5()
+    for i in range(start, end, DATA_URI_CHUNK_SIZE):
+        hashobj.update(text[i:min(i + DATA_URI_CHUNK_SIZE, end)].encode('ascii'))
+    return hashobj.hexdigest()
+
+def save_data_uri_payload(text, start, end, savepath):
+    """
+    Decode the base64 payload `text[start:end]` in chunks and save it to `savepath`.
+    """
+    with atomic_write(savepath) as f:
+        for i in range(start, end, DATA_URI_CHUNK_SIZE):
+            f.write(base64.b64decode(text[i:min(i + DATA_URI_CHUNK_SIZE, end)]))
 
 def get_hash_value(text_or_bytes):
     if not type(text_or_bytes) == bytes:
@@ -505,79 +1419,127 @@ def get_hash_value(text_or_bytes):
     hashobj.update(text_or_bytes)
     return hashobj.hexdigest()
 
-def replace_base64_images(page):
-    imgs = page.find('body').find_all('img')
-    replacement_src = None
-    for img in imgs:
+# Resizing results are cached by the content hash of the source image and the
+# target width, so images already processed are not decoded again on re-runs.
+RESIZED_IMAGES_CACHE_DIR = 'chefdata/cache/resizedimages/'
+RESIZED_IMAGES_CACHE = JsonDiskCache(RESIZED_IMAGES_CACHE_DIR)
+RESIZABLE_IMAGE_FORMATS = {        # {file extension: (PIL format, save options)}
+    '.png': ('PNG', dict(compress_level=2)),
+    '.jpg': ('JPEG', dict(quality=90)),
+    '.jpeg': ('JPEG', dict(quality=90)),
+    '.gif': ('GIF', dict()),
+    '.bmp': ('BMP', dict()),
+    '.webp': ('WEBP', dict(quality=90)),
+}
+
+def is_resizable_image(path):
+    _, ext = os.path.splitext(path)
+    return ext.lower() in RESIZABLE_IMAGE_FORMATS
+
+def get_file_hash(path):
+    hashobj = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            hashobj.update(chunk)
+    return hashobj.hexdigest()
 
-        # Step 1. First pre-process any base64 images and download them
-        m = get_base64_encoding(img['src'])
-        if m:
-            if m.group(1) == 'svg+xml':
-                ext = '.svg'
-            elif m.group(1) == 'png':
-                ext = '.png'
+def resize_image_if_needed(path, max_width=EXERCISE_IMAGE_MAX_WIDTH):
+    """
+    Resize the image at `path` if it is wider than `max_width` and return the
+    path of the resized image (images in EXERCISE_DOWNLOADED_IMAGES_DIR are
+    saved to EXERCISE_IMAGES_DIR, other images are resized in place).
+    Only the image header is read to get the image size (`Image.open` is lazy),
+    and results are cached so images seen before are not processed again.
+    """
+    with libmetrics.timer('image_resize'):
+        return _resize_image_if_needed(path, max_width=max_width)
+
+def _resize_image_if_needed(path, max_width=EXERCISE_IMAGE_MAX_WIDTH):
+    from PIL import Image
+    try:
+        source_hash = get_file_hash(path)
+        cache_key = '{}_w{}'.format(source_hash, max_width)
+        entry = RESIZED_IMAGES_CACHE.get_entry(cache_key)
+        if entry and os.path.exists(entry['path']):
+            libmetrics.incr('resized_image_cache_hits')
+            return entry['path']
+
+        with Image.open(path) as image:
+            image_width, image_height = image.size
+            if image_width <= max_width or getattr(image, 'is_animated', False):
+                print('image is not too large (or is animated) so leaving alone...')
+                destpath = path
+                resized = False
             else:
-                print(m.group(1))
-                raise ValueError('Uknown base64 image format')
-            b64data = m.group(2)
-            imgdata = base64.b64decode(b64data)
-            hashvalue = get_hash_value(b64data)
-            filename = hashvalue + ext
-            savepath = os.path.join(EXERCISE_IMAGES_DIR, filename)
-            if not os.path.exists(savepath):
-                with open(savepath, 'wb') as f:
-                    f.write(imgdata)
-            replacement_src = savepath
-        else:
-            replacement_src = img['src']
-        
-        # Step 2. Download image at `replacement_src` if is a HTTP resource
-        httpm = re.search('http[s]?://', replacement_src)
-        if httpm:
-            try:
-                response = requests.get(replacement_src)
-                if response.status_code == 200:
-                    _, imgfilename = os.path.split(replacement_src)
-                    _, ext = os.path.splitext(imgfilename)
-                    if ext == '':
-                        ext = '.png'
-                    dfilename = get_hash_value(replacement_src) + ext
-                    downloadpath = os.path.join(EXERCISE_DOWNLOADED_IMAGES_DIR, dfilename)
-                    with open(downloadpath, 'wb') as f:
-                        f.write(response.content)
-                    replacement_src = downloadpath
-                else:
-                    print('Problem downloading image ', replacement_src)
-            except (HTTPError, ConnectionError) as e:
-                LOGGER.warning('Failed to download img src=' + replacement_src)
-
-        # Step 3. Resize image at `replacement_src` if necessary
-        if replacement_src.endswith('.png') and 'http' not in replacement_src:
-            print('replacement_src=', replacement_src)
-            try:
-                image = Image.open(replacement_src)                
-                image_width = image.size[0]
-                if image_width > EXERCISE_IMAGE_MAX_WIDTH:
-                    wpercent = (float(EXERCISE_IMAGE_MAX_WIDTH)/float(image.size[0]))
-                    image_height = int((float(image.size[1])*float(wpercent)))
-                    image = image.resize((EXERCISE_IMAGE_MAX_WIDTH, image_height), Image.LANCZOS)
-                    destpath = replacement_src.replace(EXERCISE_DOWNLOADED_IMAGES_DIR, EXERCISE_IMAGES_DIR)
-                    image.save(destpath, compress_level=2)
-                    print('resized image', replacement_src, 'to', destpath)
-                    replacement_src = destpath
-                else:
-                    print('image is not too large so leaving alone...')
+                wpercent = (float(max_width)/float(image_width))
+                new_height = int((float(image_height)*float(wpercent)))
+                resized_image = image.resize((max_width, new_height), Image.LANCZOS)
+                destpath = path.replace(EXERCISE_DOWNLOADED_IMAGES_DIR, EXERCISE_IMAGES_DIR)
+                _, ext = os.path.splitext(path)
+                image_format, save_options = RESIZABLE_IMAGE_FORMATS[ext.lower()]
+                if image_format == 'JPEG' and resized_image.mode not in ['RGB', 'L']:
+                    resized_image = resized_image.convert('RGB')
+                buffer = BytesIO()
+                resized_image.save(buffer, format=image_format, **save_options)
+                write_file_atomically(destpath, buffer.getvalue())
+                print('resized image', path, 'to', destpath)
+                libmetrics.incr('images_resized')
+                resized = True
+
+        RESIZED_IMAGES_CACHE.set_entry(cache_key, dict(path=destpath))
+        if resized:
+            # also remember the resized image itself as already processed
+            resized_key = '{}_w{}'.format(get_file_hash(destpath), max_width)
+            RESIZED_IMAGES_CACHE.set_entry(resized_key, dict(path=destpath))
+        return destpath
+
+    except OSError as e:
+        print('WARNING problem downloading image', path, 'so skipping...')
+        return path
 
-            except OSError as e:
-                print('WARNING problem downloading image', replacement_src, 'so skipping...')
 
-        else:
-            pass
-            # print('not resizing image because it is not a png', replacement_src)
-        img['src'] = replacement_src
+def replace_base64_images(page):
+    imgs = page.find('body').find_all('img')
+    for img in imgs:
+        replace_img_src(img)
     return page
 
+def replace_img_src(img):
+    """
+    Save base64 images and download HTTP images to local files, resizing them
+    if necessary, and set the `src` of `img` to the local path.
+    """
+    # Step 1. First pre-process any base64 images and download them
+    src = img['src']
+    data_uri = parse_base64_image_data_uri(src)
+    if data_uri:
+        subtype, start, end = data_uri
+        ext = get_image_extension(subtype)
+        hashvalue = get_data_uri_payload_hash(src, start, end)
+        filename = hashvalue + ext
+        savepath = os.path.join(EXERCISE_IMAGES_DIR, filename)
+        if not os.path.exists(savepath):
+            save_data_uri_payload(src, start, end, savepath)
+        replacement_src = savepath
+    else:
+        replacement_src = src
+
+    # Step 2. Download image at `replacement_src` if is a HTTP resource
+    httpm = re.search('http[s]?://', replacement_src)
+    if httpm:
+        downloadpath = download_image(replacement_src)
+        if downloadpath:
+            replacement_src = downloadpath
+
+    # Step 3. Resize image at `replacement_src` if necessary
+    if 'http' not in replacement_src and is_resizable_image(replacement_src):
+        print('replacement_src=', replacement_src)
+        replacement_src = resize_image_if_needed(replacement_src)
+    else:
+        pass
+        # print('not resizing image because it is not a raster image', replacement_src)
+    img['src'] = replacement_src
+
 
 def replace_text_in_tables(page):
     """
@@ -591,46 +1553,161 @@ def replace_text_in_tables(page):
         for row in rows:
             tds = row.find_all('td')
             for td in tds:
-                if td.get('colspan') or td.get('rowspan'):
-                    raise UnsupportedMarkdowSyntaxError
-                new_children = []
-                for child in td.children:
-                    if type(child) == NavigableString:
-                        if child.strip() == '':
-                            continue
-                        else:
-                            new_children.append(child)
-                    elif child.name == 'p':
-                        # replace p tag with its contents
-                        for gchild in child.children:
-                            new_children.append(gchild)
-                    else:
-                        new_children.append(child)
-                    child.extract()    # remove child element from containing td
-                for new_child in new_children:  # add all new_children to the td
-                    td.append(new_child)
+                replace_text_in_td(td)
     return page
 
+def replace_text_in_td(td):
+    from bs4.element import NavigableString
+    if td.get('colspan') or td.get('rowspan'):
+        raise UnsupportedMarkdowSyntaxError
+    new_children = []
+    for child in td.children:
+        if type(child) == NavigableString:
+            if child.strip() == '':
+                continue
+            else:
+                new_children.append(child)
+        elif child.name == 'p':
+            # replace p tag with its contents
+            for gchild in child.children:
+                new_children.append(gchild)
+        else:
+            new_children.append(child)
+        child.extract()    # remove child element from containing td
+    for new_child in new_children:  # add all new_children to the td
+        td.append(new_child)
+
 def clean_img_attributes(page):
     """
     Remove image alt and data-mathml attributes because they confuse html2text.
     """
     imgs = page.find_all('img')
     for img in imgs:
-        img['alt'] = ''
-        img['data-mathml'] = ''
+        clean_img(img)
+    return page
+
+def clean_img(img):
+    img['alt'] = ''
+    img['data-mathml'] = ''
+
+
+def normalize_html(page):
+    """
+    Apply the same changes as `replace_base64_images`, `replace_text_in_tables`,
+    and `clean_img_attributes` to `page` in a single traversal of its body.
+    """
+    for element in page.find('body').find_all(['img', 'td']):
+        if element.name == 'img':
+            replace_img_src(element)
+            clean_img(element)
+        else:
+            for i in range(get_td_visits(element)):
+                replace_text_in_td(element)
     return page
 
+def get_td_visits(td):
+    """
+    Return the number of times `replace_text_in_tables` calls `replace_text_in_td`
+    on `td`: once for each enclosing table and row (tr or th) of that table that
+    contains `td`. It is 1 for a td in a simple table, more for nested tables,
+    and 0 for a td without a row or table (lxml keeps those). `replace_text_in_td`
+    can reorder the text of a td each time, so the counts must be the same.
+    """
+    visits = 0
+    rows = 0
+    for parent in td.parents:
+        if parent.name in ['tr', 'th']:
+            rows += 1
+        elif parent.name == 'table':
+            visits += rows
+    return visits
+
+
+# Parser used by BeautifulSoup in text_from_html: html5lib (default) or lxml,
+# which is much faster but may give different results for invalid HTML.
+HTML_PARSERS = ['html5lib', 'lxml']
+HTML_PARSER = 'html5lib'
+
+def configure_html_parser(parser='html5lib'):
+    global HTML_PARSER
+    if parser not in HTML_PARSERS:
+        raise ValueError('Unknown HTML parser ' + str(parser))
+    HTML_PARSER = parser
+
+# Memoization of text_from_html, since the same HTML fragments (short answer
+# choices, common hints, figures) appear in many questions. Conversions can also
+# be saved to disk to be reused in later runs using --persist-html-cache.
+HTML_CONVERSION_CACHE_SIZE = 20000
+HTML_CONVERSION_CACHE = LRUCache(maxsize=HTML_CONVERSION_CACHE_SIZE)
+HTML_CONVERSION_DISK_CACHE_DIR = 'chefdata/cache/markdown/'
+HTML_CONVERSION_DISK_CACHE = None
+UNSUPPORTED_MARKDOWN = None   # cached result for HTML that raises UnsupportedMarkdowSyntaxError
+
+def configure_html_conversion_cache(maxsize=HTML_CONVERSION_CACHE_SIZE, persist=False):
+    global HTML_CONVERSION_CACHE, HTML_CONVERSION_DISK_CACHE
+    HTML_CONVERSION_CACHE = LRUCache(maxsize=maxsize)
+    HTML_CONVERSION_DISK_CACHE = JsonDiskCache(HTML_CONVERSION_DISK_CACHE_DIR) if persist else None
+
+def get_html_conversion_stats():
+    """
+    Return the number of cache `hits` (of which `disk_hits` from the disk cache)
+    and of `misses` (actual conversions) of text_from_html in this run, taken
+    from the run metrics so that the worker processes are included.
+    """
+    snapshot = libmetrics.get_snapshot()
+    disk_hits = snapshot['counters'].get('html_conversion_disk_cache_hits', 0)
+    return dict(
+        hits=snapshot['counters'].get('html_conversion_cache_hits', 0) + disk_hits,
+        disk_hits=disk_hits,
+        misses=snapshot['stages'].get('html_conversion', {}).get('calls', 0),
+    )
+
+def get_html_conversion_key(html):
+    settings = [TRANSFORM_VERSION, HTML_PARSER, EXERCISE_IMAGE_MAX_WIDTH]
+    return get_content_hash(json.dumps(settings) + html)
+
 def text_from_html(html):
     """
     Extract the markdown contents from an HTML snippet
+    (memoized version of `convert_html_to_markdown`).
     """
-    page = BeautifulSoup(html, 'html5lib')
+    key = get_html_conversion_key(html)
+    text = HTML_CONVERSION_CACHE.get(key, default=False)
+    if text is not False:
+        libmetrics.incr('html_conversion_cache_hits')
+    if text is False and HTML_CONVERSION_DISK_CACHE is not None:
+        entry = HTML_CONVERSION_DISK_CACHE.get_entry(key)
+        if entry and images_resolved(entry['text']):
+            libmetrics.incr('html_conversion_disk_cache_hits')
+            text = entry['text']
+            HTML_CONVERSION_CACHE.set(key, text)
+    if text is False:
+        try:
+            with libmetrics.timer('html_conversion'):
+                text = convert_html_to_markdown(html)
+        except UnsupportedMarkdowSyntaxError:
+            text = UNSUPPORTED_MARKDOWN
+        HTML_CONVERSION_CACHE.set(key, text)
+        # conversions with images that failed to download are not saved, so
+        # that the downloads are retried in the next run
+        if HTML_CONVERSION_DISK_CACHE is not None and images_resolved(text):
+            HTML_CONVERSION_DISK_CACHE.set_entry(key, dict(text=text))
+    if text is UNSUPPORTED_MARKDOWN:
+        raise UnsupportedMarkdowSyntaxError
+    return text
+
+def convert_html_to_markdown(html):
+    """
+    Extract the markdown contents from an HTML snippet
+    """
+    from bs4 import BeautifulSoup
+    from html2text import html2text
+    page = BeautifulSoup(html, HTML_PARSER)
     # note  BeautifulSoup turned the HTML fragment into a valid HTML document
     # by wrapping in  html > body > {}  and elements
-    page = replace_base64_images(page)
-    page = replace_text_in_tables(page)
-    page = clean_img_attributes(page)
+    if page.find('body') is None:
+        return ''   # lxml doesn't create a body for empty documents
+    page = normalize_html(page)
     clean_html = ''.join(str(el) for el in page.find('body').children)
     text = html2text(clean_html, bodywidth=0)
     return text.strip()
@@ -647,21 +1724,291 @@ def full_description_str_from_component(component):
 
 
 
+# COURSE BUILDS
+################################################################################
+
+# Partial json trees of each course, written when building with --shards or
+# --build-shard and merged into the channel json tree.
+SHARDS_DIR = 'chefdata/trees/shards/'
+
+def configure_chef(args):
+    """
+    Apply the chef's command line `args` (dict) to the module-level settings.
+    """
+    import libhttp
+    configure_component_cache(mode=args['cache'], ttl=args['cache_ttl']*3600)
+    libhttp.configure_session(
+        timeout=(libhttp.DEFAULT_TIMEOUT[0], args['http_timeout']),
+        retries=args['http_retries'],
+        pool_maxsize=args['http_pool_size'],
+    )
+    configure_record_replay(record=args['record'], replay_base_url=args['replay'])
+    configure_http_retries(args['http_retries'])
+    configure_incremental_build(enabled=args['incremental'])
+    clear_imported_nodes()
+    configure_image_downloads(revalidate=args['revalidate_images'])
+    configure_prefetch(workers=args['prefetch_workers'])
+    configure_html_parser(args['html_parser'])
+    configure_html_conversion_cache(persist=args['persist_html_cache'])
+    configure_page_cache(ttl=args['page_cache_ttl']*3600)
+    libmetrics.configure_tracing(args['trace'])
+    libscheduler.configure_scheduler(
+        rate=args['rate_limit'],
+        burst=max(1, int(args['rate_limit'])),
+        max_concurrency=args['max_concurrency'],
+    )
+    configure_checkpoints(resume=args['resume_build'])
+
+
+def get_selected_course_web_resources():
+    """
+    Return the courses from the crawling stage output that are in EDRAAK_SELECTED_COURSES.
+    """
+    with open(CRAWLING_STAGE_OUTPUT, 'r') as jsonf:
+        channel_web_rsrc = json.load(jsonf)
+    course_web_resources = []
+    for course_web_resouece in channel_web_rsrc['children'][0]['children']:
+        if course_web_resouece['root_component_id'] in EDRAAK_SELECTED_COURSES:
+            course_web_resources.append(course_web_resouece)
+        else:
+            print('Skipping course', course_web_resouece['title'], 'id=', course_web_resouece['root_component_id'])
+    return course_web_resources
+
+def get_course_web_resource(course_id):
+    for course_web_resouece in get_selected_course_web_resources():
+        if course_web_resouece['root_component_id'] == course_id:
+            return course_web_resouece
+    raise ValueError('Course ' + course_id + ' not found in selected courses')
+
+
+def build_course_node(course_web_resouece, workers=1):
+    """
+    Fetch the course and all its components and return the course topic node.
+    """
+    root_component_id = course_web_resouece['root_component_id']
+    checkpoint_key = get_course_checkpoint_key(root_component_id)
+    found, topic_dict = get_checkpoint(checkpoint_key)
+    if found:
+        print('Restored course', course_web_resouece['title'], 'id=', root_component_id, 'from checkpoint')
+        return topic_dict
+    course = get_component_from_id(root_component_id)
+    print('Processing course', course['title'], 'id=', course['id'] )
+    start = time.time()
+    leaf_ids = get_leaf_component_ids(course, is_finished=is_finished_component if RESUME else None)
+    num_fetched = prefetch_components(leaf_ids, max_workers=PREFETCH_WORKERS)
+    LOGGER.info('Prefetched {} components in {:.1f}s'.format(num_fetched, time.time() - start))
+    start = time.time()
+    image_urls = []
+    for component in COMPONENT_STORE.values():
+        image_urls.extend(get_image_urls_from_component(component))
+    num_images = prefetch_images(image_urls, max_workers=PREFETCH_WORKERS)
+    LOGGER.info('Prefetched {} images in {:.1f}s'.format(num_images, time.time() - start))
+    start = time.time()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            topic_dict = node_from_component(course, executor=executor)
+    else:
+        topic_dict = node_from_component(course)
+    libmetrics.add_time('transform', time.time() - start)
+    LOGGER.info('Transformed course in {:.1f}s'.format(time.time() - start))
+    if NODE_CACHE is not None:
+        LOGGER.info('Incremental build: reused {reused} nodes, converted {converted} nodes'.format(**INCREMENTAL_STATS))
+    if IMPORTED_NODES_STATS['reused']:
+        LOGGER.info('Imported components: built {built} subtrees, reused them {reused} times '
+                    '(saved converting {reused_leaves} leaf components)'.format(**IMPORTED_NODES_STATS))
+    COMPONENT_STORE.clear()
+    COMPONENT_FETCH_TIMES.clear()
+    SUBTREE_CONTENT_HASHES.clear()
+    clear_imported_nodes()
+    clear_incremental_stats()
+    if topic_dict:
+        topic_dict['thumbnail'] = course_web_resouece['thumbnail_url']
+    save_checkpoint(checkpoint_key, topic_dict)
+    return topic_dict
+
+
+def get_shard_path(course_id):
+    return os.path.join(SHARDS_DIR, course_id + '.json')
+
+def build_course_shard(course_web_resouece, workers=1):
+    """
+    Build the course node and save it to the course's partial json tree file.
+    """
+    topic_dict = build_course_node(course_web_resouece, workers=workers)
+    shard_path = get_shard_path(course_web_resouece['root_component_id'])
+    with libmetrics.timer('json_write'):
+        write_file_atomically(shard_path, json.dumps(topic_dict, ensure_ascii=False))
+    return shard_path
+
+def build_course_shard_in_worker(course_web_resouece, workers=1, processes=0):
+    # The question pool is shut down before returning, since the shard worker
+    # process can't exit while its own worker processes are running.
+    configure_question_process_pool(processes)
+    try:
+        shard_path = build_course_shard(course_web_resouece, workers=workers)
+    finally:
+        configure_question_process_pool(0)
+    return shard_path, libmetrics.pop_snapshot()
+
+def init_shard_worker(args):
+    libmetrics.start_run()   # forked workers start with a copy of the parent's metrics
+    args = dict(args, record=False)   # workers can't share the recordings index
+    configure_chef(args)
+    # the shard workers share the request limits
+    scheduler_settings = libscheduler.get_scheduler().get_settings()
+    libscheduler.configure_scheduler(**libscheduler.split_settings(scheduler_settings, max(args['shards'], 1)))
+
+def build_course_shards(course_web_resources, args):
+    """
+    Build the partial json trees of `course_web_resources` in `args['shards']`
+    worker processes (courses that already have a partial json tree are skipped
+    when `args['merge_shards']` is set). Returns the paths of the partial json
+    trees in the same order as `course_web_resources`.
+    """
+    missing_courses = course_web_resources
+    if args['merge_shards']:
+        missing_courses = [c for c in course_web_resources
+                           if not os.path.exists(get_shard_path(c['root_component_id']))]
+    if args['record'] and args['shards']:
+        LOGGER.warning('Responses are not recorded in shard worker processes')
+    if missing_courses:
+        num_shards = min(args['shards'] or 1, len(missing_courses))
+        with ProcessPoolExecutor(max_workers=num_shards, initializer=init_shard_worker,
+                                 initargs=(args,)) as executor:
+            workers = [args['workers']]*len(missing_courses)
+            processes = [args['processes']]*len(missing_courses)
+            results = executor.map(build_course_shard_in_worker, missing_courses, workers, processes)
+            for shard_path, metrics_snapshot in results:
+                libmetrics.merge(metrics_snapshot)
+    return [get_shard_path(c['root_component_id']) for c in course_web_resources]
+
+
+def print_slowest_spans(n=20):
+    for category in ['component', 'question']:
+        print('Slowest', category + 's:')
+        for event in libmetrics.get_slowest_spans(n, category=category):
+            print('  {:8.3f}s  {} {}  {}'.format(
+                event['dur']/1e6, event['args']['component_type'], event['name'],
+                json.dumps({key: value for key, value in event['args'].items() if key != 'component_type'})))
+
+
+
+
 # CHEF
 ################################################################################
 
-class EdraakChef(JsonTreeChef):
+def positive_float(value):
+    """
+    Argument type for options like --rate-limit that must be greater than 0.
+    """
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError('must be greater than 0, got ' + value)
+    return number
+
+class EdraakChefMixin(object):
     """
     The chef class that takes care of uploading channel to Kolibri Studio.
     We'll call its `main()` method from the command line script.
+    The chef class combines these methods with ricecooker's JsonTreeChef (see
+    `get_chef_class`) so that ricecooker is only imported to run the chef.
     """
     RICECOOKER_JSON_TREE = 'edraak_ricecooker_json_tree.json'
 
+    def __init__(self, *args, **kwargs):
+        import libhttp
+        super(EdraakChefMixin, self).__init__(*args, **kwargs)
+        self.arg_parser = argparse.ArgumentParser(
+            description='Edraak sushi chef.',
+            parents=[self.arg_parser],
+        )
+        self.arg_parser.add_argument('--cache', choices=COMPONENT_CACHE_MODES, default='default',
+            help='How to use the on-disk cache of Edraak API components: default (use '
+                 'fresh entries, revalidate stale ones), refresh (re-download everything), '
+                 'or only (offline, never hit the network).')
+        self.arg_parser.add_argument('--cache-ttl', type=float, default=COMPONENT_CACHE_TTL/3600,
+            help='Number of hours after which cached components are revalidated.')
+        self.arg_parser.add_argument('--http-timeout', type=float, default=libhttp.DEFAULT_TIMEOUT[1],
+            help='Timeout in seconds for API and image HTTP requests.')
+        self.arg_parser.add_argument('--http-retries', type=int, default=libhttp.DEFAULT_RETRIES,
+            help='Number of times to retry HTTP requests that fail with connection errors or 429/5xx.')
+        self.arg_parser.add_argument('--http-pool-size', type=int, default=libhttp.DEFAULT_POOL_MAXSIZE,
+            help='Maximum number of connections per host (requests wait for a free connection).')
+        self.arg_parser.add_argument('--rate-limit', type=positive_float, default=libscheduler.DEFAULT_RATE,
+            help='Max number of requests per second to each host (shared by API, image, and browser requests).')
+        self.arg_parser.add_argument('--max-concurrency', type=int, default=libscheduler.DEFAULT_MAX_CONCURRENCY,
+            help='Max number of concurrent requests to each host (lowered automatically on 429s and rising latency).')
+        self.arg_parser.add_argument('--workers', type=int, default=1,
+            help='Number of threads used to fetch and convert videos and exercises.')
+        self.arg_parser.add_argument('--prefetch-workers', type=int, default=PREFETCH_WORKERS,
+            help='Number of threads used to prefetch the components and images of each course.')
+        self.arg_parser.add_argument('--incremental', action='store_true',
+            help='Reuse the nodes generated in the previous run for components that did not change.')
+        self.arg_parser.add_argument('--revalidate-images', action='store_true',
+            help='Check if previously downloaded exercise images changed on the server.')
+        self.arg_parser.add_argument('--html-parser', choices=HTML_PARSERS, default='html5lib',
+            help='Parser used to convert question HTML to markdown (lxml is faster).')
+        self.arg_parser.add_argument('--persist-html-cache', action='store_true',
+            help='Save HTML to markdown conversions to disk to reuse them in later runs.')
+        self.arg_parser.add_argument('--processes', type=int, nargs='?', default=0, const=os.cpu_count(),
+            help='Number of processes used to convert exercise questions (default is to use '
+                 'the main process, --processes without a value uses one process per CPU).')
+        self.arg_parser.add_argument('--crawl', action='store_true',
+            help='Re-run the crawling stage to update ' + CRAWLING_STAGE_OUTPUT + '.')
+        self.arg_parser.add_argument('--page-cache-ttl', type=float, default=PAGE_CACHE_TTL/3600,
+            help='Number of hours after which pages cached by the crawling stage are re-visited.')
+        self.arg_parser.add_argument('--invalidate-page-cache', action='store_true',
+            help='Clear the cache of pages, component urls, and parent ids used by the crawling stage.')
+        self.arg_parser.add_argument('--record', action='store_true',
+            help='Record all the HTTP responses in chefdata/recordings/ for use with --replay.')
+        self.arg_parser.add_argument('--replay', metavar='BASE_URL', default=None,
+            help='Get all pages, components, and images from the replay server at BASE_URL '
+                 '(see libreplay.py) instead of from edraak.org.')
+        self.arg_parser.add_argument('--shards', type=int, default=0,
+            help='Build each selected course in one of SHARDS worker processes, then merge them.')
+        self.arg_parser.add_argument('--build-shard', metavar='COURSE_ID', default=None,
+            help='Only build the partial json tree of course COURSE_ID in ' + SHARDS_DIR + ' and exit.')
+        self.arg_parser.add_argument('--resume-build', action='store_true',
+            help='Continue an interrupted run from the checkpoints in ' + CHECKPOINTS_DIR + '.')
+        self.arg_parser.add_argument('--trace', action='store_true',
+            help='Record a tracing span for each component and question, and save them to '
+                 + libmetrics.REPORTS_DIR + ' in Chrome trace format.')
+        self.arg_parser.add_argument('--trace-top', type=int, default=20,
+            help='Number of slowest components and questions to print when using --trace.')
+        self.arg_parser.add_argument('--merge-shards', action='store_true',
+            help='Reuse the partial json trees in ' + SHARDS_DIR + ' (e.g. built on other machines '
+                 'with --build-shard) and only build the missing ones.')
+
     def pre_run(self, args, options):
         """
         Build the ricecooker json tree for the entire channel.
         """
         LOGGER.info('in pre_run...')
+        libmetrics.start_run()
+        self.workers = args['workers']
+        self.shard_args = args
+        configure_chef(args)
+        if not args['resume_build']:
+            clear_checkpoints()
+        elif args['record']:
+            LOGGER.warning('Responses for nodes restored from checkpoints are not recorded')
+        if args['build_shard'] or not (args['shards'] or args['merge_shards']):
+            # courses are built in this process (shard workers start their own pools)
+            configure_question_process_pool(args['processes'])
+        if args['invalidate_page_cache']:
+            invalidate_page_cache()
+        if args['crawl']:
+            build_web_resource_tree(START_URL)
+        if args['build_shard']:
+            course_web_resource = get_course_web_resource(args['build_shard'])
+            shard_path = build_course_shard(course_web_resource, workers=self.workers)
+            configure_question_process_pool(0)
+            clear_checkpoints()
+            LOGGER.info('Saved course shard to ' + shard_path)
+            libmetrics.write_report(args={key: value for key, value in args.items() if key != 'token'})
+            if libmetrics.TRACING:
+                libmetrics.write_trace()
+            sys.exit(0)
 
         ricecooker_json_tree = dict(
             title='Edraak (العربيّة)',          # a humand-readbale title
@@ -672,30 +2019,67 @@ class EdraakChef(JsonTreeChef):
             language=getlang('ar').code    ,          # language code of channel
             children=[],
         )
-        self.add_content_nodes(ricecooker_json_tree)
-        # self.add_sample_content_nodes(ricecooker_json_tree)
-
+        # Each course subtree is written to the json tree file as soon as it is
+        # built, so only one course at a time is kept in memory.
         json_tree_path = self.get_json_tree_path()
-        write_tree_to_json_tree(json_tree_path, ricecooker_json_tree)
+        try:
+            with StreamingJsonTreeWriter(json_tree_path, ricecooker_json_tree) as channel_writer:
+                self.add_content_nodes(channel_writer)
+                # self.add_sample_content_nodes(ricecooker_json_tree)
+        finally:
+            configure_question_process_pool(0)
+        clear_checkpoints()   # the channel was built successfully
+        if RECORDINGS is not None:
+            RECORDINGS.save()
+
+        LOGGER.info('HTML conversions: {hits} cache hits ({disk_hits} from disk), {misses} misses'.format(
+            **get_html_conversion_stats()))
+        import libhttp
+        http_connections = libhttp.get_connection_stats()
+        for host, host_stats in sorted(http_connections.items()):
+            LOGGER.info('HTTP {}: {} requests over {} connections ({} reused)'.format(
+                host, host_stats['requests'], host_stats['connections'], host_stats['reused']))
+        for host, host_stats in sorted(libscheduler.get_scheduler().get_stats().items()):
+            LOGGER.info('Scheduler {}: {} requests, {} throttled, {} errors, concurrency {}, waited {}s'.format(
+                host, host_stats['requests'], host_stats['throttled'], host_stats['errors'],
+                host_stats['concurrency'], host_stats['wait_time']))
+        report_path = libmetrics.write_report(
+            args={key: value for key, value in args.items() if key != 'token'},
+            http_connections=http_connections,
+            scheduler=libscheduler.get_scheduler().get_stats(),
+            incremental=get_incremental_totals() if NODE_CACHE is not None else None,
+        )
+        LOGGER.info('Saved run report to ' + report_path)
+        if libmetrics.TRACING:
+            trace_path = libmetrics.write_trace()
+            LOGGER.info('Saved trace to ' + trace_path)
+            print_slowest_spans(args['trace_top'])
 
 
-    def add_content_nodes(self, channel):
+    def add_content_nodes(self, channel_writer):
         """
-        Build the hierarchy of topic nodes and content nodes.
+        Build the hierarchy of topic nodes and content nodes and add each course
+        to the json tree using `channel_writer.add_child`.
         """
         LOGGER.info('Creating channel content nodes...')
-        channel_web_rsrc = json.load(open(CRAWLING_STAGE_OUTPUT,'r'))
-        for course_web_resouece in channel_web_rsrc['children'][0]['children']:
-            root_component_id = course_web_resouece['root_component_id']
-            course = get_component_from_id(root_component_id)
-            if root_component_id in EDRAAK_SELECTED_COURSES:
-                print('Processing course', course['title'], 'id=', course['id'] )
-                topic_dict = node_from_component(course)
-                topic_dict['thumbnail'] = course_web_resouece['thumbnail_url']
-                channel['children'].append(topic_dict)
+        course_web_resources = get_selected_course_web_resources()
+        if self.shard_args['shards'] or self.shard_args['merge_shards']:
+            shard_paths = build_course_shards(course_web_resources, self.shard_args)
+            for shard_path in shard_paths:
+                with open(shard_path, 'r') as jsonf:
+                    topic_dict = json.load(jsonf)
+                if topic_dict:
+                    with libmetrics.timer('json_write'):
+                        channel_writer.add_child(topic_dict)
+                del topic_dict
+        else:
+            for course_web_resouece in course_web_resources:
+                topic_dict = build_course_node(course_web_resouece, workers=self.workers)
+                if topic_dict:
+                    with libmetrics.timer('json_write'):
+                        channel_writer.add_child(topic_dict)
+                del topic_dict
                 print('\n')
-            else:
-                print('Skipping course', course['title'], 'id=', course['id'] )
 
 
     # def add_sample_content_nodes(self, channel):
@@ -751,6 +2135,14 @@ class EdraakChef(JsonTreeChef):
 
 
 
+def get_chef_class():
+    from ricecooker.chefs import JsonTreeChef
+    class EdraakChef(EdraakChefMixin, JsonTreeChef):
+        pass
+    return EdraakChef
+
+
+
 # CLI
 ################################################################################
 
@@ -758,5 +2150,6 @@ if __name__ == '__main__':
     """
     This code will run when the sushi chef script is called on the command line.
     """
+    EdraakChef = get_chef_class()
     chef = EdraakChef()
     chef.main()
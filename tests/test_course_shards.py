@@ -0,0 +1,69 @@
+"""
+Tests of building courses in shard worker processes (--shards), using courses
+from benchmarks/fixtures.py that are saved to the component cache and built
+with --cache=only. Each build runs in a new Python process that must exit
+before BUILD_TIMEOUT, so that worker processes that never exit fail the test.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+BUILD_TIMEOUT = 60     # seconds
+
+BUILD_SCRIPT = """
+import json, sys
+sys.path[:0] = {paths!r}
+import fixtures, sushichef
+course, components = fixtures.make_course(num_sections=2, num_subsections=1, num_lessons=1,
+                                          questions_per_exercise=3)
+sushichef.configure_component_cache(mode='only')
+course_web_resources = []
+for i in range({num_courses}):
+    course_id = 'course{{:04d}}'.format(i)
+    sushichef.COMPONENT_CACHE.set_entry(course_id, dict(data=dict(course, id=course_id)))
+    course_web_resources.append(dict(title=course['title'], root_component_id=course_id, thumbnail_url=None))
+for component_id, component in components.items():
+    sushichef.COMPONENT_CACHE.set_entry(component_id, dict(data=component))
+args = vars(sushichef.get_chef_class()().arg_parser.parse_args({argv!r}))
+shard_paths = sushichef.build_course_shards(course_web_resources, args)
+print(json.dumps(shard_paths))
+"""
+
+
+def build_course_shards(work_dir, argv, num_courses=2):
+    """
+    Build `num_courses` courses with the command line arguments `argv` in a new
+    Python process and return the paths of their partial json trees.
+    """
+    script = BUILD_SCRIPT.format(paths=[REPO_DIR, os.path.join(REPO_DIR, 'benchmarks')],
+                                 num_courses=num_courses, argv=['--cache=only'] + argv)
+    process = subprocess.Popen([sys.executable, '-c', script], cwd=str(work_dir),
+                               stdout=subprocess.PIPE, start_new_session=True)
+    try:
+        output, _ = process.communicate(timeout=BUILD_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)   # including the worker processes
+        process.communicate()
+        pytest.fail('Building the shards with {} did not finish in {}s'.format(argv, BUILD_TIMEOUT))
+    assert process.returncode == 0
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize('argv', [
+    ['--shards=2'],
+    ['--shards=2', '--processes=2'],
+])
+def test_build_course_shards(tmp_path, argv):
+    shard_paths = build_course_shards(tmp_path, argv)
+    assert len(shard_paths) == 2
+    for shard_path in shard_paths:
+        with open(os.path.join(str(tmp_path), shard_path), 'r') as jsonf:
+            topic_dict = json.load(jsonf)
+        assert topic_dict['title'] == 'التفاضل والتكامل'
+        assert len(topic_dict['children']) == 2
@@ -0,0 +1,143 @@
+"""
+Golden tests of the HTML to markdown conversion of question HTML. The expected
+markdown in golden/markdown.json was generated with the original three-pass
+conversion (`replace_base64_images`, `replace_text_in_tables`, and
+`clean_img_attributes`), so these tests check that `convert_html_to_markdown`
+(which uses `normalize_html`) gives identical results. To regenerate the golden
+file after an intended change of the generated markdown, run:
+
+    python tests/test_html_conversion.py
+"""
+import json
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+import fixtures
+import sushichef
+
+
+GOLDEN_PATH = os.path.join(TESTS_DIR, 'golden', 'markdown.json')
+SVG_DATA_URI = 'data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciLz4='
+
+EDGE_CASES = {
+    'empty': '',
+    'whitespace': ' \n ',
+    'nested_tables': '<table><tr><td><table><tr><td><p> a <b>x</b> </p>\n<p>b</p></td></tr></table></td></tr></table>',
+    'nested_tables_3_levels': ('<table><tr><td><p>1</p> <table><tr><td><p>2</p>\n<p>3</p><table><tr><td>'
+                               '<p> 4 </p>\n<p>5</p></td></tr></table></td></tr></table></td></tr></table>'),
+    'bare_td': '<td><p>a</p>\n\n<p>b</p></td>',
+    'td_without_tr': '<table><td><p>a</p>\n<p>b</p></td></table>',
+    'th_row': '<table><tr><th><p>h</p></th></tr><tr><td><p>a</p>\n<p>b</p></td></tr></table>',
+    'td_in_th': '<table><tr><th><td><p>a</p><p>b</p></td></th></tr></table>',
+    'colspan': '<table><tr><td colspan="2"><p>a</p></td></tr></table>',
+    'rowspan_nested': '<table><tr><td><table><tr><td rowspan="2">a</td></tr></table></td></tr></table>',
+    'entities': '<p>&nbsp;٣٫٥ &lt;x&gt; &amp; &quot;q&quot; &#1575;</p>',
+    'unclosed_tags': '<p>one <b>two <i>three<p>four</b> five',
+    'rtl': '<p dir="rtl" style="text-align: justify;"><span>مستخدماً التقدير الذهني، أجب عن السؤال</span></p>',
+    'svg_image': '<p><img src="' + SVG_DATA_URI + '" alt="formula" data-mathml="&lt;math/&gt;" /></p>',
+    'image_in_table': '<table><tr><td><p><img src="' + SVG_DATA_URI + '" alt="x" /></p>\n<p>b</p></td></tr></table>',
+}
+
+
+def get_test_cases():
+    """
+    Returns {name: html} of the fixture fragments and the edge cases.
+    """
+    cases = {}
+    for i, html in enumerate(fixtures.make_html_fragments(count=30)):
+        cases['fragment_{:02d}'.format(i)] = html
+    cases['tables_page'] = fixtures.make_tables_page_html(num_tables=3)
+    cases['images_page'] = fixtures.make_images_page_html(num_images=4)
+    cases.update(EDGE_CASES)
+    return cases
+
+
+def convert_html_to_markdown_in_three_passes(html):
+    """
+    The original conversion, which `convert_html_to_markdown` must match.
+    """
+    from bs4 import BeautifulSoup
+    from html2text import html2text
+    page = BeautifulSoup(html, sushichef.HTML_PARSER)
+    if page.find('body') is None:
+        return ''
+    page = sushichef.replace_base64_images(page)
+    page = sushichef.replace_text_in_tables(page)
+    page = sushichef.clean_img_attributes(page)
+    clean_html = ''.join(str(el) for el in page.find('body').children)
+    text = html2text(clean_html, bodywidth=0)
+    return text.strip()
+
+
+def convert(convert_function, html):
+    try:
+        return convert_function(html)
+    except sushichef.UnsupportedMarkdowSyntaxError:
+        return None
+
+
+def load_golden():
+    with open(GOLDEN_PATH, 'r') as jsonf:
+        return json.load(jsonf)
+
+
+@pytest.fixture(autouse=True)
+def chef_work_dir(tmp_path, monkeypatch):
+    """
+    Run each test in a temporary directory (images are saved to chefdata/).
+    """
+    monkeypatch.chdir(tmp_path)
+    yield
+    sushichef.configure_html_parser()
+
+
+CASES = get_test_cases()
+
+
+@pytest.mark.parametrize('parser', sushichef.HTML_PARSERS)
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_markdown_matches_golden(parser, name):
+    sushichef.configure_html_parser(parser)
+    expected = load_golden()[parser][name]
+    assert convert(sushichef.convert_html_to_markdown, CASES[name]) == expected
+
+
+@pytest.mark.parametrize('parser', sushichef.HTML_PARSERS)
+@pytest.mark.parametrize('name', sorted(EDGE_CASES))
+def test_markdown_matches_three_passes(parser, name):
+    sushichef.configure_html_parser(parser)
+    html = EDGE_CASES[name]
+    expected = convert(convert_html_to_markdown_in_three_passes, html)
+    assert convert(sushichef.convert_html_to_markdown, html) == expected
+
+
+def test_td_visits():
+    from bs4 import BeautifulSoup
+    page = BeautifulSoup(EDGE_CASES['nested_tables'], 'html5lib')
+    outer_td, inner_td = page.find_all('td')
+    assert sushichef.get_td_visits(outer_td) == 1
+    assert sushichef.get_td_visits(inner_td) == 3
+    page = BeautifulSoup(EDGE_CASES['bare_td'], 'lxml')
+    assert sushichef.get_td_visits(page.find('td')) == 0
+
+
+if __name__ == '__main__':
+    import tempfile
+    golden = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        for parser in sushichef.HTML_PARSERS:
+            sushichef.configure_html_parser(parser)
+            golden[parser] = {name: convert(convert_html_to_markdown_in_three_passes, html)
+                              for name, html in sorted(CASES.items())}
+    with open(GOLDEN_PATH, 'w') as jsonf:
+        json.dump(golden, jsonf, indent=2, sort_keys=True, ensure_ascii=False)
+        jsonf.write('\n')
+    print('Saved', GOLDEN_PATH)